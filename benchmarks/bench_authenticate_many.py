@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compares Server.authenticate in a loop with Server.authenticate_many.
+
+Usage: python benchmarks/bench_authenticate_many.py
+"""
+import timeit
+
+import hawk
+
+CREDS = dict(('id-%d' % i, {'id': 'id-%d' % i,
+                            'key': 'secret key %d' % i,
+                            'algorithm': 'sha256'}) for i in range(20))
+BATCH = 500
+
+
+def make_batch(payload_size):
+    """Builds a batch of signed requests spread over a few credentials."""
+    payload = 'x' * payload_size
+    reqs = []
+    for i in range(BATCH):
+        creds = CREDS['id-%d' % (i % len(CREDS))]
+        header = hawk.client.header(
+            'http://example.com/resource/%d?a=b' % i, 'POST',
+            {'credentials': creds, 'payload': payload,
+             'contentType': 'text/plain'})
+        reqs.append({'method': 'POST', 'url': '/resource/%d?a=b' % i,
+                     'host': 'example.com', 'port': 80,
+                     'contentType': 'text/plain', 'payload': payload,
+                     'headers': {'authorization': header['field']}})
+    return reqs
+
+
+def loop(reqs):
+    hawk.nonce.clear()
+    for req in reqs:
+        server = hawk.Server(req, CREDS.get)
+        server.authenticate({'payload': req['payload']})
+
+
+def batch(reqs):
+    hawk.nonce.clear()
+    hawk.Server.authenticate_many(reqs, CREDS.get)
+
+
+def main():
+    for size in [0, 1024, 1024 * 1024]:
+        reqs = make_batch(size)
+        for name, func in [('loop', loop), ('authenticate_many', batch)]:
+            seconds = min(timeit.repeat(lambda: func(reqs), number=1,
+                                        repeat=3))
+            print '%7d byte payloads %-18s %8.0f requests/sec' % (
+                size, name, len(reqs) / seconds)
+
+
+if __name__ == '__main__':
+    main()
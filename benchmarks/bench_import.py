@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures how long `import hawk` takes in a fresh interpreter.
+
+Usage:
+
+    python benchmarks/bench_import.py --max-ms 50
+
+Each run times the import from inside a fresh child interpreter, so
+nothing is cached by an earlier import. (`python -X importtime` needs
+Python 3.7, which can not import the Python 2 only hawk package.) The
+best of --repeat runs is printed, and the exit status is 1 when it is
+above --max-ms.
+"""
+import optparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMED_IMPORT = ('import time; start = time.time(); import hawk; '
+                'print(int((time.time() - start) * 1e6))')
+
+
+def import_usec():
+    """Returns the microseconds one fresh interpreter spends on hawk."""
+    output = subprocess.check_output([sys.executable, '-c', TIMED_IMPORT],
+                                     cwd=ROOT)
+    return int(output.strip())
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--repeat', type='int', default=10,
+                      help='fresh interpreters to start, the best is kept')
+    parser.add_option('--max-ms', type='float',
+                      help='fail when importing takes longer than this')
+    options, _ = parser.parse_args()
+
+    best = min(import_usec() for _ in range(options.repeat))
+    print('import hawk %10.2f ms' % (best / 1000.0))
+    if options.max_ms is not None and best / 1000.0 > options.max_ms:
+        print('slower than the allowed %.2f ms' % options.max_ms)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
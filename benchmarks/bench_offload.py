@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compares inline and offloaded payload hashing in Authenticator.authenticate
+with several threads verifying large uploads at once.
+
+Usage: python benchmarks/bench_offload.py
+"""
+import threading
+import time
+
+import hawk
+
+CREDS = {'id': 'bench-client', 'key': 'secret key', 'algorithm': 'sha256'}
+REQUESTS = 64
+
+
+def make_requests(payload_size):
+    """Builds signed upload requests with distinct nonces."""
+    payload = 'x' * payload_size
+    reqs = []
+    for i in range(REQUESTS):
+        header = hawk.client.header(
+            'http://example.com/upload/%d' % i, 'POST',
+            {'credentials': CREDS, 'payload': payload,
+             'contentType': 'text/plain'})
+        reqs.append({'method': 'POST', 'url': '/upload/%d' % i,
+                     'host': 'example.com', 'port': 80,
+                     'contentType': 'text/plain',
+                     'headers': {'authorization': header['field']}})
+    return reqs, payload
+
+
+def run(authenticator, reqs, payload, threads):
+    """Verifies reqs on threads threads, returns requests per second."""
+    hawk.nonce.clear()
+    chunks = [reqs[i::threads] for i in range(threads)]
+
+    def worker(chunk):
+        for req in chunk:
+            authenticator.authenticate(req, payload)
+
+    workers = [threading.Thread(target=worker, args=(chunk,))
+               for chunk in chunks]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return len(reqs) / (time.time() - start)
+
+
+def main():
+    # The requests are signed once up front, so allow for a long run
+    inline = hawk.Authenticator(lambda cid: CREDS,
+                                timestamp_skew_sec=3600)
+    offload = hawk.Authenticator(lambda cid: CREDS, timestamp_skew_sec=3600,
+                                 offload_hash_bytes=1024 * 1024)
+    for size in [1024 * 1024, 8 * 1024 * 1024]:
+        reqs, payload = make_requests(size)
+        for threads in [1, 2, 4]:
+            for name, authenticator in [('inline', inline),
+                                        ('offload', offload)]:
+                rate = max(run(authenticator, reqs, payload, threads)
+                           for _ in range(3))
+                print '%8d bytes %d threads %-8s %8.1f requests/sec' % (
+                    size, threads, name, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the per-header cost of hawk.util.parse_authorization_header.
+
+Usage: python benchmarks/bench_parse_header.py
+"""
+import timeit
+
+from hawk.util import parse_authorization_header
+
+HEADERS = {
+    'authorization': (
+        'Hawk id="dh37fgj492je", ts="1367076201", nonce="NPHgnG", '
+        'ext="and welcome!", '
+        'mac="CeWHy4d9kbLGhDlkyw2Nh3PJ7SDOdZDa267KH4ZaNMY="'),
+    'authorization (long ext)': (
+        'Hawk id="dh37fgj492je", ts="1367076201", nonce="NPHgnG", '
+        'ext="' + 'a=b, ' * 200 + '", '
+        'mac="CeWHy4d9kbLGhDlkyw2Nh3PJ7SDOdZDa267KH4ZaNMY="'),
+    'server-authorization': (
+        'Hawk mac="okjCR+o26FMhInYoJ1QO30Fu9cl3wGIWmwqydQXND+w=", '
+        'hash="y+iZjG+hr2is3SmZLFOe551/LGS3PQPMY9ZWjToaNjg=", '
+        'ext="and welcome!"'),
+    'www-authenticate': (
+        'Hawk ts="1367076201", '
+        'tsm="okjCR+o26FMhInYoJ1QO30Fu9cl3wGIWmwqydQXND+w=", '
+        'error="Stale timestamp"'),
+}
+
+KEYS = {
+    'server-authorization': ['mac', 'ext', 'hash'],
+    'www-authenticate': ['ts', 'tsm', 'error'],
+}
+
+
+def main(number=100000):
+    for name in sorted(HEADERS):
+        header = HEADERS[name]
+        keys = KEYS.get(name)
+        seconds = min(timeit.repeat(
+            lambda: parse_authorization_header(header, keys),
+            number=number, repeat=3))
+        print '%-28s %5d bytes %8.2f usec/header' % (
+            name, len(header), seconds / number * 1e6)
+
+
+if __name__ == '__main__':
+    main()
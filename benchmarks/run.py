@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmarks for the public HAWK hot paths.
+
+Usage:
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --compare baseline.json --threshold 0.15
+
+Every case is timed for at least --min-time seconds, the best of --repeat
+runs is kept. Results are written as JSON, keyed by case name. In compare
+mode the run fails (exit status 1) when a case is slower than the baseline
+by more than the threshold.
+"""
+import json
+import optparse
+import platform
+import sys
+import tempfile
+import time
+
+import hawk
+import hawk.hcrypto as hcrypto
+from hawk.util import parse_authorization_header
+
+CREDS = {
+    'id': 'bench-client',
+    'key': 'werxhqb98rpaxn39848xrunpaw3489ruxnpa98w4rxn',
+    'algorithm': 'sha256',
+}
+URL = 'http://example.com:8000/resource/1?b=1&a=2'
+PAYLOAD_SIZES = [0, 1024, 64 * 1024, 1024 * 1024, 10 * 1024 * 1024,
+                 100 * 1024 * 1024]
+EXT_LENGTHS = [0, 64, 1024]
+
+SERVER_OPTIONS = {'check_nonce_fn': None, 'timestampSkewSec': 10 ** 9}
+
+
+def credentials_fn(cid):
+    """Looks up the benchmark credentials."""
+    if cid != CREDS['id']:
+        raise KeyError(cid)
+    return CREDS
+
+
+def signed_request(method, payload=None, ext=None, timestamp=None):
+    """Returns a client header and the matching server request dict."""
+    options = {'credentials': CREDS, 'contentType': 'text/plain'}
+    if payload is not None:
+        options['payload'] = payload
+    if ext:
+        options['ext'] = ext
+    if timestamp is not None:
+        options['timestamp'] = timestamp
+    header = hawk.client.header(URL, method, options)
+    req = {'method': method, 'url': '/resource/1?b=1&a=2',
+           'host': 'example.com', 'port': 8000, 'contentType': 'text/plain',
+           'headers': {'authorization': header['field']}}
+    return header, req
+
+
+def rejected(authenticator, req):
+    """Authenticates a request which is expected to be rejected."""
+    try:
+        authenticator.authenticate(req)
+    except hawk.HawkException:
+        return
+    raise AssertionError('request was not rejected')
+
+
+def cases(max_payload):
+    """Yields (name, function) pairs, one per benchmarked case."""
+    payload_sizes = [s for s in PAYLOAD_SIZES if s <= max_payload]
+
+    for size in payload_sizes:
+        payload = 'x' * size
+        yield ('calculate_payload_hash/%d' % size,
+               lambda payload=payload: hcrypto.calculate_payload_hash(
+                   payload, 'sha256', 'text/plain'))
+
+        client_options = {'credentials': CREDS, 'payload': payload,
+                          'contentType': 'text/plain'}
+        yield ('client.header/payload=%d' % size,
+               lambda o=client_options: hawk.client.header(URL, 'POST', o))
+
+        _, req = signed_request('POST', payload)
+        options = dict(SERVER_OPTIONS, payload=payload)
+        yield ('Server.authenticate/payload=%d' % size,
+               lambda req=req, options=options:
+               hawk.Server(req, credentials_fn).authenticate(options))
+
+    for ext_len in EXT_LENGTHS:
+        ext = 'e' * ext_len
+        header, req = signed_request('GET', ext=ext)
+        client_options = {'credentials': CREDS, 'ext': ext}
+        yield ('client.header/ext=%d' % ext_len,
+               lambda o=client_options: hawk.client.header(URL, 'GET', o))
+
+        signer = hawk.client.Signer(CREDS)
+        yield ('Signer.header/ext=%d' % ext_len,
+               lambda s=signer, o=client_options: s.header(URL, 'GET', o))
+
+        yield ('parse_authorization_header/ext=%d' % ext_len,
+               lambda h=header['field']: parse_authorization_header(h))
+
+        yield ('Server.authenticate/ext=%d' % ext_len,
+               lambda req=req:
+               hawk.Server(req, credentials_fn).authenticate(
+                   dict(SERVER_OPTIONS)))
+
+        server = hawk.Server(req, credentials_fn)
+        artifacts = server.authenticate(dict(SERVER_OPTIONS))
+        response_options = {'payload': 'Hello', 'contentType': 'text/plain',
+                            'ext': ext}
+        yield ('Server.header/ext=%d' % ext_len,
+               lambda s=server, a=artifacts, o=response_options:
+               s.header(a, o))
+
+        response = {'headers': {
+            'content-type': 'text/plain',
+            'server-authorization': server.header(artifacts,
+                                                  response_options)}}
+        yield ('client.authenticate/ext=%d' % ext_len,
+               lambda r=response, a=header['artifacts']:
+               hawk.client.authenticate(r, CREDS, a, {'payload': 'Hello'}))
+
+        bewit_options = {'credentials': CREDS, 'ttl_sec': 3600, 'ext': ext}
+        yield ('client.get_bewit/ext=%d' % ext_len,
+               lambda o=bewit_options: hawk.client.get_bewit(URL, o))
+
+        uris = ['http://example.com:8000/resource/%d?b=1' % i
+                for i in range(100)]
+        yield ('client.get_bewits/100/ext=%d' % ext_len,
+               lambda u=uris, e=ext:
+               hawk.client.get_bewits(u, CREDS, 3600, e))
+
+        bewit = hawk.client.get_bewit(URL, bewit_options)
+        bewit_req = {'method': 'GET', 'host': 'example.com', 'port': 8000,
+                     'url': '/resource/1?b=1&a=2&bewit=' + bewit,
+                     'headers': {}}
+        yield ('Server.authenticate_bewit/ext=%d' % ext_len,
+               lambda r=bewit_req:
+               hawk.Server(r, credentials_fn).authenticate_bewit({}))
+
+    # Static response bodies, the payload hash comes from the cache
+    _, req = signed_request('GET')
+    server = hawk.Server(req, credentials_fn)
+    artifacts = server.authenticate(dict(SERVER_OPTIONS))
+    body = 'x' * min(1024 * 1024, max_payload)
+    yield ('Server.header/contentKey=%d' % len(body),
+           lambda s=server, a=artifacts, b=body:
+           s.header(a, {'payload': b, 'contentType': 'text/plain',
+                        'contentKey': 'bench-body'}))
+
+    body_file = tempfile.NamedTemporaryFile(prefix='pyhawk-bench-')
+    body_file.write(body)
+    body_file.flush()
+    yield ('Server.header/payloadFile=%d' % len(body),
+           lambda s=server, a=artifacts, f=body_file:
+           s.header(a, {'payloadFile': f.name, 'contentType': 'text/plain'}))
+
+    def cold_payload_file():
+        hcrypto.payload_hash_cache.clear()
+        server.header(artifacts, {'payloadFile': body_file.name,
+                                  'contentType': 'text/plain'})
+
+    yield 'Server.header/payloadFile=%d/cold' % len(body), cold_payload_file
+
+    # Payload hash and header MAC per registered algorithm
+    for algorithm in hcrypto.algorithms():
+        creds = dict(CREDS, algorithm=algorithm)
+        for size in [s for s in [1024, 1024 * 1024] if s <= max_payload]:
+            payload = 'x' * size
+            yield ('calculate_payload_hash/%s/%d' % (algorithm, size),
+                   lambda payload=payload, a=algorithm:
+                   hcrypto.calculate_payload_hash(payload, a, 'text/plain'))
+
+        artifacts = hawk.client.header(URL, 'GET',
+                                       {'credentials': creds})['artifacts']
+        yield ('calculate_mac/%s' % algorithm,
+               lambda c=creds, a=artifacts:
+               hcrypto.calculate_mac('header', c, a))
+
+    # Rejections, with the cheap stages first and with the MAC first
+    late_stages = ('limits', 'credentials', 'mac', 'payload', 'timestamp',
+                   'nonce')
+    store = hawk.NonceStore()
+    for name, stages in [('', hawk.server.DEFAULT_STAGES),
+                         ('/late-checks', late_stages)]:
+        authenticator = hawk.Authenticator(credentials_fn, nonce_store=store,
+                                           stages=stages)
+        stale = signed_request('GET', timestamp=time.time() - 3600)[1]
+        yield ('Authenticator.authenticate/stale%s' % name,
+               lambda a=authenticator, r=stale: rejected(a, r))
+
+        replay = signed_request('GET')[1]
+        authenticator.authenticate(replay)
+        yield ('Authenticator.authenticate/replay%s' % name,
+               lambda a=authenticator, r=replay: rejected(a, r))
+
+    # Cold credentials: the keyed HMAC state has to be rebuilt every time
+    _, req = signed_request('GET')
+
+    def cold_authenticate():
+        hcrypto.key_cache.clear()
+        hawk.Server(req, credentials_fn).authenticate(dict(SERVER_OPTIONS))
+
+    yield 'Server.authenticate/cold', cold_authenticate
+
+    def cold_header():
+        hcrypto.key_cache.clear()
+        hawk.client.header(URL, 'GET', {'credentials': CREDS})
+
+    yield 'client.header/cold', cold_header
+
+
+def measure(func, min_time, repeat):
+    """Returns the best seconds per call over repeat runs."""
+    func()
+    best = None
+    for _ in range(repeat):
+        number = 0
+        start = time.time()
+        elapsed = 0.0
+        while elapsed < min_time:
+            func()
+            number += 1
+            elapsed = time.time() - start
+        per_call = elapsed / number
+        if best is None or per_call < best:
+            best = per_call
+    return best
+
+
+def run(options):
+    """Runs every selected case, returns the results dict."""
+    results = {}
+    for name, func in cases(options.max_payload):
+        if options.filter and options.filter not in name:
+            continue
+        seconds = measure(func, options.min_time, options.repeat)
+        results[name] = {'usec_per_op': seconds * 1e6,
+                         'ops_per_sec': 1.0 / seconds}
+        print '%-45s %14.2f usec/op %12.0f ops/sec' % (
+            name, seconds * 1e6, 1.0 / seconds)
+        sys.stdout.flush()
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'pyhawk': hawk.__version__,
+        'results': results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """Prints the slowdown per case, returns the names of regressions."""
+    regressions = []
+    for name in sorted(current['results']):
+        if name not in baseline['results']:
+            continue
+        now = current['results'][name]['usec_per_op']
+        then = baseline['results'][name]['usec_per_op']
+        change = now / then - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print '%-45s %+8.1f%%%s' % (name, change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--output', help='write results as JSON to this file')
+    parser.add_option('--compare', help='baseline JSON file to compare with')
+    parser.add_option('--threshold', type='float', default=0.15,
+                      help='allowed slowdown in compare mode (0.15 = 15%)')
+    parser.add_option('--max-payload', type='int',
+                      default=PAYLOAD_SIZES[-1],
+                      help='largest payload size in bytes to benchmark')
+    parser.add_option('--filter', help='only run cases containing this')
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help='minimum seconds per timing run')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='timing runs per case, the best is kept')
+    options, _ = parser.parse_args()
+
+    current = run(options)
+
+    if options.output:
+        with open(options.output, 'w') as out:
+            json.dump(current, out, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print
+        regressions = compare(current, baseline, options.threshold)
+        if regressions:
+            print '%d case(s) regressed by more than %d%%' % (
+                len(regressions), options.threshold * 100)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
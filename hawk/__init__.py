@@ -9,17 +9,17 @@ Python library for HAWK
 
 """
 
-import pkg_resources
-
 __title__ = 'pyhawk'
-__version__ = pkg_resources.get_distribution(__title__).version
+# Read by setup.py, importing pkg_resources to look it up is slow
+__version__ = '0.1.3'
 __build__ = 0x010200
 __copyright__ = 'Copyright 2013 Mozilla'
 
 
 import client
-from .server import Server  # NOQA
+from .server import Authenticator, Server  # NOQA
 from .hcrypto import InvalidBewit  # NOQA
+from .nonce import NonceStore  # NOQA
 from .util import HawkException  # NOQA
 
 
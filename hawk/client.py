@@ -6,8 +6,8 @@ Server APIs for HAWK Authentication.
 
 import logging
 import math
-import pprint
 import time
+from base64 import b64encode, urlsafe_b64encode
 
 import hawk.hcrypto as hcrypto
 import hawk.util as util
@@ -15,6 +15,10 @@ from hawk.server import BadRequest
 
 log = logging.getLogger(__name__)
 
+# Clock offsets in msec learned from signed server timestamps (the
+# WWW-Authenticate ts and tsm), by (host, port). header() applies them.
+clock_offsets = util.LRUCache(max_size=1024)
+
 
 def header(url, method, options=None):
     """
@@ -34,10 +38,12 @@ def header(url, method, options=None):
     '2334f34f':  A pre-generated nonce
     localtimeOffsetMsec:
     Time offset to sync with server time (ignored if timestamp
-    provided) (Example 400)
+    provided) (Example 400). Defaults to the offset learned from the
+    last signed server timestamp of the host, see clock_offsets.
     payload:
     UTF-8 encoded string for body hash generation (ignored if hash
-    provided) (Example '{"some":"payload"}')
+    provided) (Example '{"some":"payload"}'). A hcrypto.PayloadHasher
+    fed with the body may be passed instead to avoid buffering it.
     contentType:
     Payload content-type (ignored if hash provided) (Example
     'application/json')
@@ -47,6 +53,9 @@ def header(url, method, options=None):
     Oz application id ('24s23423f34dx')
     dlg:
     Oz delegated-by application id - '234sz34tww3sd'
+
+    Returns a dict of field, the Authorization header, and artifacts, a
+    util.Artifacts. Use artifacts.to_dict() to serialize them as JSON.
     """
     result = {'field': '', 'artifacts': {}}
 
@@ -71,84 +80,180 @@ def header(url, method, options=None):
         log.info("Bad credentail elements skipping")
         return result
 
-    timestamp = math.floor(time.time())
-    if 'timestamp' in options:
-        offset = 0
-        if 'localtimeOffsetMsec' in options:
-            offset = int(options['localtimeOffsetMsec'])
-        timestamp = math.floor(options['timestamp'] + offset)
+    url_parts = util.parse_normalized_url(url)
 
-    if 'nonce' not in options:
-        options['nonce'] = hcrypto.random_string(6)
+    log.debug('parsed URL parts: %r', url_parts)
 
-    url_parts = util.parse_normalized_url(url)
+    artifacts = _request_artifacts(options, method, url_parts['resource'],
+                                   url_parts['hostname'], url_parts['port'],
+                                   cred['algorithm'])
+    result['artifacts'] = artifacts
 
-    # TODO use None or '' for these optional artifacts?
-    if 'hash' not in options:
-        options['hash'] = None
-    if 'ext' not in options:
-        options['ext'] = None
-    if 'app' not in options:
-        options['app'] = None
-    if 'dlg' not in options:
-        options['dlg'] = None
+    log.debug('artifacts=%r', artifacts)
 
-    resource = url_parts['resource']
+    mac = hcrypto.calculate_mac('header', cred, artifacts)
 
-    log.debug('parsed URL parts: %s' % pprint.pformat(url_parts))
+    result['field'] = _header_field('Hawk id="' + cred['id'] + '", ts="',
+                                    artifacts, mac)
 
-    artifacts = {
-        'ts': int(timestamp),
-        'nonce': options['nonce'],
-        'method': method,
-        'resource': resource,
-        'host': url_parts['hostname'],
-        'port': url_parts['port'],
-        'hash': options['hash'],
-        'ext': options['ext'],
-        'app': options['app'],
-        'dlg': options['dlg']
-    }
+    return result
 
-    result['artifacts'] = artifacts
 
-    if artifacts['hash'] is None and 'payload' in options:
-        if 'contentType' not in options:
-            options['contentType'] = 'text/plain'
-        log.debug('about to hash payload: %s' % options['payload'])
-        log.debug('algorithm=%s, contentType=%s'
-                  % (cred['algorithm'], options['contentType']))
-        artifacts['hash'] = hcrypto.calculate_payload_hash(
-               options['payload'], cred['algorithm'], options['contentType'])
+def _request_artifacts(options, method, resource, host, port, algorithm):
+    """Builds the artifacts of a request from client.header options."""
+    if 'timestamp' in options:
+        timestamp = math.floor(options['timestamp'])
+    else:
+        offset = options.get('localtimeOffsetMsec')
+        if offset is None:
+            offset = clock_offsets.get((host, port), 0)
+        timestamp = math.floor(time.time() + int(offset) / 1000.0)
+
+    # options is never modified, callers may share it between threads
+    artifacts = util.Artifacts(
+        ts=int(timestamp),
+        nonce=options.get('nonce') or hcrypto.nonce_generator(6),
+        method=method,
+        resource=resource,
+        host=host,
+        port=port,
+        hash=options.get('hash'),
+        ext=options.get('ext'),
+        app=options.get('app'),
+        dlg=options.get('dlg'))
+
+    if artifacts.hash is None and 'payload' in options:
+        content_type = options.get('contentType', 'text/plain')
+        log.debug('about to hash payload: %r', options['payload'])
+        log.debug('algorithm=%s, contentType=%s', algorithm, content_type)
+        artifacts.hash = hcrypto.calculate_payload_hash(
+               options['payload'], algorithm, content_type)
+
+    if artifacts.hash is None:
+        artifacts.hash = ''
+
+    return artifacts
+
+
+def _header_field(prefix, artifacts, mac):
+    """Assembles the Authorization header, prefix ends with 'ts="'.
+
+    artifacts come from _request_artifacts, so every field read is set.
+    """
+    parts = [prefix, str(artifacts.ts), '", nonce="', artifacts.nonce, '"']
 
-    log.debug('artifacts=%s' % pprint.pformat(artifacts))
+    if artifacts.hash:
+        parts.extend([', hash="', artifacts.hash, '"'])
 
-    mac = hcrypto.calculate_mac('header', cred, artifacts)
+    if artifacts.ext:
+        util.check_header_attribute(artifacts.ext)
+        h_ext = artifacts.ext.replace('\\', '\\\\').replace('\n', '\\n')
+        parts.extend([', ext="', h_ext, '"'])
 
-    _header = ''.join([
-        'Hawk id="', cred['id'], '"',
-        ', ts="', str(artifacts['ts']), '"',
-        ', nonce="', artifacts['nonce'], '"',
-    ])
+    parts.extend([', mac="', mac, '"'])
 
-    if len(artifacts['hash']) > 0:
-        _header += ', hash="' + artifacts['hash'] + '"'
+    if artifacts.app is not None:
+        parts.extend([', app="', artifacts.app, '"'])
+        if artifacts.dlg is not None:
+            parts.extend([', dlg="', artifacts.dlg, '"'])
 
-    if artifacts['ext'] is not None and len(artifacts['ext']) > 0:
-        util.check_header_attribute(artifacts['ext'])
-        h_ext = artifacts['ext'].replace('\\', '\\\\').replace('\n', '\\n')
-        _header += ', ext="' + h_ext + '"'
+    return ''.join(parts)
 
-    _header += ', mac="' + mac + '"'
 
-    if artifacts['app'] is not None:
-        _header += ', app="' + artifacts['app'] + '"'
-        if artifacts['dlg'] is not None:
-            _header += ', dlg="' + artifacts['dlg'] + '"'
+class Signer(object):
+    """Signs requests with one set of credentials.
 
-    result['field'] = _header
+    Validates the credentials and prepares the keyed HMAC and the
+    'Hawk id="..."' header prefix once. The host and port of every origin
+    signed for are cached, so each header() call only does the work that
+    depends on the URL path, timestamp, nonce and payload.
 
-    return result
+    :param credentials: dict of id, key and algorithm
+    :param base_url: optional 'http://example.com:8000', header() then also
+                     accepts paths such as '/resource?a=b'
+    :param max_origins: number of scheme://host:port origins to cache
+    """
+
+    def __init__(self, credentials, base_url=None, max_origins=256):
+        if not credentials or 'id' not in credentials or \
+                'key' not in credentials or 'algorithm' not in credentials:
+            raise BadRequest
+        self.credentials = credentials
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self._keyed = hcrypto.key_cache.hmac_for(credentials)
+        self._prefix = 'Hawk id="' + credentials['id'] + '", ts="'
+        self._origins = util.LRUCache(max_origins)
+
+    def header(self, url, method, options=None):
+        """Returns the same dict as client.header(url, method, options),
+        without the 'credentials' option."""
+        if options is None:
+            options = {}
+        if self.base_url is not None and url.startswith('/'):
+            url = self.base_url + url
+
+        host, port, resource = self._split(url)
+        artifacts = _request_artifacts(options, method, resource, host, port,
+                                       self.credentials['algorithm'])
+
+        mac = b64encode(hcrypto.keyed_digest(self._keyed, 'header', artifacts))
+
+        return {'field': _header_field(self._prefix, artifacts, mac),
+                'artifacts': artifacts}
+
+    def bewit(self, url, exp, ext=''):
+        """Returns the bewit for url, valid until the exp timestamp.
+
+        Same as get_bewit for a ttl_sec which ends at exp.
+        """
+        if self.base_url is not None and url.startswith('/'):
+            url = self.base_url + url
+        host, port, resource = self._split(url)
+        artifacts = {
+            'ts': int(exp),
+            'nonce': '',
+            'method': 'GET',
+            'resource': resource,
+            'host': host,
+            'port': str(port),
+            'ext': ext or ''
+            }
+        mac = urlsafe_b64encode(
+            hcrypto.keyed_digest(self._keyed, 'bewit', artifacts))
+
+        # Construct bewit: id\exp\mac\ext
+        return urlsafe_b64encode('\\'.join([self.credentials['id'],
+                                             str(int(exp)), mac,
+                                             artifacts['ext']]))
+
+    def _split(self, url):
+        """Returns host, port and resource of an absolute url."""
+        scheme_end = url.find('://')
+        path_start = -1
+        if scheme_end > 0:
+            path_start = len(url)
+            for sep in '/?#':
+                pos = url.find(sep, scheme_end + 3)
+                if pos != -1 and pos < path_start:
+                    path_start = pos
+        rest = url[path_start:]
+        if scheme_end <= 0 or ';' in rest:
+            # Leave unusual URLs to urlparse
+            url_parts = util.parse_normalized_url(url)
+            return (url_parts['hostname'], url_parts['port'],
+                    url_parts['resource'])
+
+        origin = url[:path_start]
+        host_port = self._origins.get(origin)
+        if host_port is None:
+            url_parts = util.parse_normalized_url(origin)
+            host_port = (url_parts['hostname'], url_parts['port'])
+            self._origins.set(origin, host_port)
+
+        resource = rest.split('#', 1)[0]
+        if resource.endswith('?'):
+            resource = resource[:-1]
+        return host_port[0], host_port[1], resource
 
 def authenticate(response, credentials, artifacts, options=None):
     """Validate server response.
@@ -156,23 +261,104 @@ def authenticate(response, credentials, artifacts, options=None):
     :param response: dictionary with server response
     :param artifacts:  object recieved from header().artifacts
     :param options: {
-    payload:    optional payload received
+    payload:    optional payload received, or a hcrypto.PayloadHasher
     required:   specifies if a Server-Authorization header is required.
     Defaults to 'false'
     }
     """
-    if not isinstance(response, dict) or 'headers' not in response:
+    if options is None:
+        options = {}
+
+    s_auth_attrs = _verify_response_headers(response, credentials, artifacts,
+                                            options.get('required', False))
+    if s_auth_attrs is None:
+        return True
+    if s_auth_attrs is False:
         return False
 
-    if 'content-type' not in response['headers']:
-        log.warn("response lacked content-type")
-        response['headers']['content-type'] = 'text/plain'
+    if 'payload' not in options:
+        return True
+
+    if 'hash' not in s_auth_attrs:
+        return False
+
+    p_mac = hcrypto.calculate_payload_hash(options['payload'],
+                                           credentials['algorithm'],
+                                           _content_type(response))
+    if not util.compare(p_mac, s_auth_attrs['hash']):
+        log.info("p_mac %s != %s", p_mac, s_auth_attrs['hash'])
+
+    return util.compare(p_mac, s_auth_attrs['hash'])
+
+
+def authenticate_stream(response, credentials, artifacts, body,
+                        options=None):
+    """Validate server response headers, verify the body while it is read.
+
+    The response MAC is checked from the headers alone. Instead of True
+    a hcrypto.VerifyingReader around body is returned, which hashes what
+    the caller reads and raises hcrypto.InvalidPayloadHash at the end of
+    the body if it does not match the Server-Authorization hash. Memory
+    use does not depend on the size of the body.
 
+    Returns False where authenticate() would, including when the response
+    carries no payload hash. Without a Server-Authorization header and
+    options['required'], body itself is returned unverified, test for
+    `result is body` or pass required=True to tell the cases apart.
+
+    :param response: dictionary with server response headers
+    :param artifacts:  object recieved from header().artifacts
+    :param body: file-like object with a read method, e.g. the raw
+                 response stream. A content-length header limits the
+                 reader to that many bytes, a malformed one is ignored.
+    :param options: {
+    required:   specifies if a Server-Authorization header is required.
+    Defaults to 'false'
+    }
+    """
     if options is None:
         options = {}
 
-    if 'required' not in options:
-        options['required'] = False
+    s_auth_attrs = _verify_response_headers(response, credentials, artifacts,
+                                            options.get('required', False))
+    if s_auth_attrs is None:
+        return body
+    if s_auth_attrs is False or not s_auth_attrs.get('hash'):
+        return False
+
+    length = str(response['headers'].get('content-length', '')).strip()
+    hasher = hcrypto.PayloadHasher(credentials['algorithm'],
+                                   _content_type(response))
+    # Without a usable length the body is read, and verified, up to EOF
+    return hcrypto.VerifyingReader(body, hasher, s_auth_attrs['hash'],
+                                   int(length) if length.isdigit() else None)
+
+
+def _learn_offset(artifacts, server_ts):
+    """Stores the clock offset to the server artifacts were sent to."""
+    if 'host' not in artifacts or 'port' not in artifacts:
+        return
+    offset = int(server_ts) * 1000 - int(time.time() * 1000)
+    clock_offsets.set((artifacts['host'], artifacts['port']), offset)
+
+
+def _content_type(response):
+    """Returns the content type a response payload is hashed with."""
+    content_type = response['headers'].get('content-type')
+    if content_type is None:
+        log.warn("response lacked content-type")
+        content_type = 'text/plain'
+    return content_type
+
+
+def _verify_response_headers(response, credentials, artifacts, required):
+    """Checks the WWW-Authenticate and Server-Authorization headers.
+
+    Returns the Server-Authorization attributes once the MAC is verified,
+    None if the header is missing but not required, False otherwise.
+    """
+    if not isinstance(response, dict) or 'headers' not in response:
+        return False
 
     if 'www-authenticate' in response['headers']:
         www_auth_attrs = util.parse_authorization_header(
@@ -182,13 +368,15 @@ def authenticate(response, credentials, artifacts, options=None):
         if 'ts' in www_auth_attrs:
             ts_mac = hcrypto.calculate_ts_mac(www_auth_attrs['ts'],
                                                   credentials)
-            if not util.compare(ts_mac, www_auth_attrs['ts']):
-                log.info(ts_mac + " didn't match " + www_auth_attrs['ts'])
+            tsm = www_auth_attrs.get('tsm', '')
+            if not util.compare(ts_mac, tsm):
+                log.info("%s didn't match %s", ts_mac, tsm)
                 return False
+            _learn_offset(artifacts, www_auth_attrs['ts'])
 
     if 'server-authorization' not in response['headers'] and \
-            False == options['required']:
-        return True
+            not required:
+        return None
 
     if 'server-authorization' not in response['headers']:
         log.info("Unable to verify, no server-authorization header")
@@ -197,32 +385,15 @@ def authenticate(response, credentials, artifacts, options=None):
     s_auth_attrs = util.parse_authorization_header(
         response['headers']['server-authorization'],
                 ['mac', 'ext', 'hash'])
-    if 'ext' in s_auth_attrs:
-        artifacts['ext'] = s_auth_attrs['ext']
-    else:
-        artifacts['ext'] = ''
-
-    artifacts['hash'] = s_auth_attrs['hash']
-
-    mac = hcrypto.calculate_mac('response', credentials, artifacts)
-    if not util.compare(mac, s_auth_attrs['mac']):
-        log.info("server mac mismatch " + mac + " != " + s_auth_attrs['mac'])
-        return False
-
-    if 'payload' not in options:
-        return True
-
-    if 'hash' not in s_auth_attrs:
+    mac = hcrypto.response_mac_digest(credentials, artifacts,
+                                      s_auth_attrs.get('hash', ''),
+                                      s_auth_attrs.get('ext', ''))
+    theirs = hcrypto.decode_mac(s_auth_attrs['mac'])
+    if theirs is None or not util.compare(mac, theirs):
+        log.info("server mac mismatch %s != %s", b64encode(mac),
+                 s_auth_attrs['mac'])
         return False
-
-    content_type = response['headers']['content-type']
-    p_mac = hcrypto.calculate_payload_hash(options['payload'],
-                                           credentials['algorithm'],
-                                           content_type)
-    if not util.compare(p_mac, s_auth_attrs['hash']):
-        log.info("p_mac " + p_mac + " != " + s_auth_attrs['hash'])
-
-    return util.compare(p_mac, s_auth_attrs['hash'])
+    return s_auth_attrs
 
 def get_bewit(uri, options=None):
     # XXX Where is credentials here?
@@ -261,7 +432,8 @@ def get_bewit(uri, options=None):
     if not valid_bewit_args(uri, options):
         return ''
 
-    now = time.time() + int(options['localtime_offset_msec'])
+    offset = options.get('localtime_offset_msec') or 0
+    now = time.time() + int(offset) / 1000.0
 
     creds = options['credentials']
     if 'id' not in creds or 'key' not in creds or 'algorithm' not in creds:
@@ -282,14 +454,56 @@ def get_bewit(uri, options=None):
         'resource': resource,
         'host': url_parts['hostname'],
         'port': str(url_parts['port']),
-        'ext': options['ext']
+        'ext': options.get('ext') or ''
         }
 
     return hcrypto.calculate_bewit(creds, artifacts, exp)
 
 
+def get_bewits(uris, credentials, ttl_sec, ext='', localtime_offset_msec=0,
+               pool=None, chunk_size=1000):
+    """Generate bewits for many URIs at once.
+
+    The clock is read once, the keyed HMAC is shared and the host and port
+    of each origin are parsed once. Returns the bewits in the order of
+    uris, exactly as get_bewit would for each of them.
+
+    :param uris: list of 'http://example.com/resource?a=b' strings
+    :param credentials: dict of id, key and algorithm
+    :param ttl_sec: TTL in seconds
+    :param ext: Application specific data
+    :param localtime_offset_msec: Time offset to sync with server time
+    :param pool:
+        Optional multiprocessing.Pool, batches larger than chunk_size are
+        then split into chunks and signed by its worker processes.
+    """
+    if not credentials or 'id' not in credentials or \
+            'key' not in credentials or 'algorithm' not in credentials:
+        raise BadRequest
+
+    now = time.time() + int(localtime_offset_msec or 0) / 1000.0
+    exp = now + int(ttl_sec)
+
+    if pool is not None and len(uris) > chunk_size:
+        chunks = [(credentials, uris[i:i + chunk_size], exp, ext)
+                  for i in range(0, len(uris), chunk_size)]
+        bewits = []
+        for chunk in pool.map(_bewit_chunk, chunks):
+            bewits.extend(chunk)
+        return bewits
+
+    return _bewit_chunk((credentials, uris, exp, ext))
+
+
+def _bewit_chunk(args):
+    """Signs one chunk of get_bewits, runs in pool workers too."""
+    credentials, uris, exp, ext = args
+    signer = Signer(credentials)
+    return [signer.bewit(uri, exp, ext) for uri in uris]
+
+
 def valid_bewit_args(uri, options):
-    """Validates inputs and sets defaults for options."""
+    """Validates inputs."""
     if uri is None or options is None:
         raise BadRequest
 
@@ -299,11 +513,4 @@ def valid_bewit_args(uri, options):
     if not 'ttl_sec' in options:
         return False
 
-    if 'ext' not in options or options['ext'] is None:
-        options['ext'] = ''
-
-    if 'localtime_offset_msec' not in options or \
-            options['localtime_offset_msec'] is None:
-        options['localtime_offset_msec'] = 0
-
     return True
@@ -5,19 +5,27 @@ Crypto functions for HAWK authentication
 """
 
 import logging
+import mmap
 import os
+import re
+import threading
 from base64 import b64encode, urlsafe_b64encode, urlsafe_b64decode
+from binascii import a2b_base64
 import hashlib
 import hmac
-import string
 
-from hawk.util import HawkException
+from hawk.util import Artifacts, HawkException, LRUCache, compare, \
+    normalized_fragment
 
 log = logging.getLogger(__name__)
 
 
 HAWK_VER = 1
 
+# Standard base64 with padding, as sent in mac and hash attributes
+_BASE64_RE = re.compile(r'(?:[A-Za-z0-9+/]{4})*'
+                        r'(?:[A-Za-z0-9+/]{2}==|[A-Za-z0-9+/]{3}=)?\Z')
+
 class UnknownAlgorithm(HawkException):
     """Exception raised for bad configuration of algorithm."""
     pass
@@ -28,70 +36,418 @@ class InvalidBewit(HawkException):
     pass
 
 
+class InvalidPayloadHash(HawkException):
+    """Exception raised when a streamed payload does not match its hash."""
+    pass
+
+
+class KeyCache(LRUCache):
+    """Cache of keyed HMAC objects, ready to be copied and fed.
+
+    Creating an HMAC pads the key and runs it through the inner and outer
+    digests. Doing that once per credential and copying the result saves
+    that work on every following request with the same credentials.
+    """
+
+    def __init__(self, max_size=4096, ttl_sec=3600):
+        super(KeyCache, self).__init__(max_size, ttl_sec)
+
+    def hmac_for(self, credentials):
+        """Returns a fresh HMAC object keyed with the credentials."""
+        algorithm = credentials['algorithm']
+        cache_key = (credentials.get('id'), credentials['key'], algorithm)
+        keyed = self.get(cache_key)
+        if keyed is None:
+            key = credentials['key']
+            if isinstance(key, unicode):
+                key = key.encode('utf-8')
+            keyed = hmac.new(key, None, module_for_algorithm(algorithm))
+            self.set(cache_key, keyed)
+        return keyed.copy()
+
+
+key_cache = KeyCache()
+
+
 def calculate_mac(mac_type, credentials, options, url_encode=False):
     """Calculates a message authentication code (MAC)."""
-    normalized = normalize_string(mac_type, options)
-    digestmod = module_for_algorithm(credentials['algorithm'])
-    result = hmac.new(credentials['key'], normalized, digestmod)
     if url_encode:
-        mac = urlsafe_b64encode(result.digest())
-    else:
-        mac = b64encode(result.digest())
-    return mac
+        return urlsafe_b64encode(mac_digest(mac_type, credentials, options))
+    return b64encode(mac_digest(mac_type, credentials, options))
+
+
+def mac_digest(mac_type, credentials, options):
+    """Calculates the raw digest of a MAC, see decode_mac."""
+    result = key_cache.hmac_for(credentials)
+    result.update(_utf8(normalize_string(mac_type, options)))
+    return result.digest()
+
+
+def keyed_digest(keyed, mac_type, options):
+    """Same as mac_digest, with a keyed HMAC the caller prepared.
+
+    keyed is left untouched, e.g. a Signer's KeyCache.hmac_for result.
+    """
+    result = keyed.copy()
+    result.update(_utf8(normalize_string(mac_type, options)))
+    return result.digest()
+
+
+def decode_mac(value):
+    """Decodes a base64 mac or hash attribute to its raw digest.
+
+    Returns None if value is not base64, which never matches a digest.
+    Comparing raw digests saves encoding every MAC calculated.
+    """
+    if not _BASE64_RE.match(value):
+        return None
+    return a2b_base64(value)
+
+
+def _utf8(value):
+    """Returns value as bytes, HAWK strings are UTF-8."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+# Algorithm names used in credentials, mapped to hashlib constructors
+_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+}
+for _name in ('blake2b', 'blake2s'):
+    if hasattr(hashlib, _name):
+        _ALGORITHMS[_name] = getattr(hashlib, _name)
+
+
+def register_algorithm(name, constructor):
+    """Makes credentials with the algorithm name usable.
+
+    constructor is called without arguments and returns a hashlib style
+    object, with update, digest, copy and block_size. Replacing the
+    constructor of a registered name takes effect at once, see
+    unregister_algorithm.
+    """
+    replaced = name in _ALGORITHMS
+    _ALGORITHMS[name] = constructor
+    if replaced:
+        _clear_algorithm_caches()
+
+
+def unregister_algorithm(name):
+    """Makes credentials with the algorithm name unusable again.
+
+    key_cache, the empty payload hashes and payload_hash_cache are cleared,
+    they are keyed by algorithm name.
+    """
+    if _ALGORITHMS.pop(name, None) is not None:
+        _clear_algorithm_caches()
+
+
+def _clear_algorithm_caches():
+    """Drops every cached HMAC and hash computed with a registered name."""
+    key_cache.clear()
+    _empty_hashes.clear()
+    payload_hash_cache.clear()
+
+
+def algorithms():
+    """Returns the names of the registered algorithms."""
+    return sorted(_ALGORITHMS)
 
 
 def module_for_algorithm(algorithm):
     """Returns a hashlib algorithm based on given string."""
-    if 'sha256' == algorithm:
-        return hashlib.sha256
-    else:
-        raise UnknownAlgorithm
+    try:
+        return _ALGORITHMS[algorithm]
+    except (KeyError, TypeError):
+        raise UnknownAlgorithm(algorithm)
 
 
 def normalize_string(mac_type, options):
     """Serializes mac_type and options into a HAWK string."""
-    # TODO this smells
-    if 'hash' not in options or options['hash'] is None:
-        options['hash'] = ''
+    if isinstance(options, Artifacts):
+        fragment = options.fragment()
+    else:
+        fragment = normalized_fragment(options)
+    return _join_normalized(mac_type, fragment, options.get('hash'),
+                            options.get('ext'), options.get('app'),
+                            options.get('dlg'))
 
-    normalized = '\n'.join(
-        ['hawk.' + str(HAWK_VER) + '.' + mac_type,
-         str(options['ts']),
-         options['nonce'],
-         options['method'].upper(),
-         options['resource'],
-         options['host'].lower(),
-         str(options['port']),
-         options['hash']])
 
-    normalized += '\n'
+def _join_normalized(mac_type, fragment, p_hash, ext, app, dlg):
+    """Assembles a HAWK string around the normalized_fragment."""
+    parts = ['hawk.' + str(HAWK_VER) + '.' + mac_type, '\n',
+             fragment, '\n',
+             p_hash or '', '\n']
 
-    if 'ext' in options and len(options['ext']) > 0:
-        n_ext = options['ext'].replace('\\', '\\\\').replace('\n', '\\n')
-        normalized += n_ext
+    if ext:
+        parts.append(ext.replace('\\', '\\\\').replace('\n', '\\n'))
 
-    normalized += '\n'
+    parts.append('\n')
 
-    if 'app' in options and options['app'] is not None and \
-       len(options['app']) > 0:
-        normalized += options['app'] + '\n'
-        if 'dlg' in options and options['dlg'] is not None:
-            normalized += options['dlg'] + '\n'
+    if app:
+        parts.extend([app, '\n'])
+        if dlg is not None:
+            parts.extend([dlg, '\n'])
 
-    return normalized
+    return ''.join(parts)
 
 
-def calculate_payload_hash(payload, algorithm, content_type):
-    """Calculates a hash for a given payload."""
-    p_hash = hashlib.new(algorithm)
-    p_hash.update('hawk.' + str(HAWK_VER) + '.payload\n')
-    p_hash.update(parse_content_type(content_type) + '\n')
-    if payload:
-        p_hash.update(payload)
+def calculate_response_mac(credentials, artifacts, p_hash, ext):
+    """Calculates the MAC of the response to the request of artifacts.
+
+    Only the hash and ext of a response differ from its request, the
+    normalized request fields memoized by Artifacts are reused as they
+    are, without copying the artifacts.
+    """
+    return b64encode(response_mac_digest(credentials, artifacts, p_hash,
+                                         ext))
+
+
+def response_mac_digest(credentials, artifacts, p_hash, ext):
+    """Calculates the raw digest of calculate_response_mac."""
+    if isinstance(artifacts, Artifacts):
+        fragment = artifacts.fragment()
     else:
-        p_hash.update('')
-    p_hash.update('\n')
-    return b64encode(p_hash.digest())
+        fragment = normalized_fragment(artifacts)
+    normalized = _join_normalized('response', fragment, p_hash, ext,
+                                  artifacts.get('app'), artifacts.get('dlg'))
+    result = key_cache.hmac_for(credentials)
+    result.update(_utf8(normalized))
+    return result.digest()
+
+
+def calculate_payload_hash(payload, algorithm, content_type):
+    """Calculates a hash for a given payload.
+
+    payload may also be a PayloadHasher which was fed the body as it
+    arrived, in which case its own algorithm and content type are used.
+    """
+    if isinstance(payload, PayloadHasher):
+        return payload.finalize()
+    if not payload:
+        return empty_payload_hash(algorithm, content_type)
+    p_hash = PayloadHasher(algorithm, content_type)
+    p_hash.update(payload)
+    return p_hash.finalize()
+
+
+# Hashes of empty bodies by algorithm and content type, bounded since the
+# content type may come from the request
+_empty_hashes = LRUCache(max_size=256)
+
+
+def empty_payload_hash(algorithm, content_type):
+    """Returns the hash of an empty body, computed once per content type."""
+    content_type = parse_content_type(content_type)
+    p_hash = _empty_hashes.get((algorithm, content_type))
+    if p_hash is None:
+        p_hash = PayloadHasher(algorithm, content_type).finalize()
+        _empty_hashes.set((algorithm, content_type), p_hash)
+    return p_hash
+
+
+def hash_file(path, algorithm, content_type):
+    """Calculates the payload hash of a file, read through mmap."""
+    with open(path, 'rb') as body:
+        # Empty files can not be mapped
+        if os.fstat(body.fileno()).st_size == 0:
+            return empty_payload_hash(algorithm, content_type)
+        mapped = mmap.mmap(body.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            p_hash = PayloadHasher(algorithm, content_type)
+            p_hash.update(mapped)
+            return p_hash.finalize()
+        finally:
+            mapped.close()
+
+
+class PayloadHasher(object):
+    """Incrementally computes a HAWK payload hash.
+
+    Feed the body in chunks with update() or hand over a file object or
+    iterable with update_from(), then call finalize() for the base64 hash.
+    Memory use is bounded by the chunk size, not the body size. Buffer
+    objects (bytearray, memoryview, mmap) are hashed without copying.
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, algorithm, content_type):
+        self.algorithm = algorithm
+        self.content_type = content_type
+        self.length = 0
+        self._hash = module_for_algorithm(algorithm)()
+        self._hash.update('hawk.' + str(HAWK_VER) + '.payload\n')
+        self._hash.update(parse_content_type(content_type) + '\n')
+        self._result = None
+
+    def update(self, chunk):
+        """Feeds a string or buffer object into the hash."""
+        if self._result is not None:
+            raise ValueError('PayloadHasher already finalized')
+        self._hash.update(chunk)
+        self.length += len(chunk)
+
+    def update_from(self, source):
+        """Feeds a file-like object (anything with read) or an iterable
+        of chunks into the hash."""
+        if hasattr(source, 'read'):
+            chunk = source.read(self.chunk_size)
+            while chunk:
+                self.update(chunk)
+                chunk = source.read(self.chunk_size)
+        else:
+            for chunk in source:
+                self.update(chunk)
+        return self
+
+    def finalize(self):
+        """Returns the base64 encoded payload hash."""
+        if self._result is None:
+            self._hash.update('\n')
+            self._result = b64encode(self._hash.digest())
+        return self._result
+
+
+class PayloadHashCache(LRUCache):
+    """Cache of payload hashes for bodies which are sent many times.
+
+    Files are cached by path, keyed by their mtime and size, so a file
+    which changed is hashed again. Other bodies are cached under a key
+    the caller provides, e.g. an ETag, which has to change whenever the
+    body does. Each entry holds the hashes of one body for every
+    algorithm and content type it was signed with.
+    """
+
+    def __init__(self, max_size=4096, ttl_sec=None):
+        super(PayloadHashCache, self).__init__(max_size, ttl_sec)
+
+    def hash_file(self, path, algorithm, content_type):
+        """Returns the payload hash of the file at path."""
+        stat = os.stat(path)
+        stamp = (stat.st_mtime, stat.st_size)
+        return self._lookup(('file', path), stamp, algorithm, content_type,
+                            lambda: hash_file(path, algorithm, content_type))
+
+    def hash_payload(self, content_key, payload, algorithm, content_type):
+        """Returns the payload hash of payload, cached under content_key."""
+        return self._lookup(
+            ('key', content_key), None, algorithm, content_type,
+            lambda: calculate_payload_hash(payload, algorithm, content_type))
+
+    def invalidate_file(self, path):
+        """Forgets the hashes of the file at path."""
+        self.invalidate(('file', path))
+
+    def invalidate_key(self, content_key):
+        """Forgets the hashes cached under content_key."""
+        self.invalidate(('key', content_key))
+
+    def _lookup(self, key, stamp, algorithm, content_type, compute):
+        """Returns a cached hash, or computes and caches it."""
+        variant = (algorithm, parse_content_type(content_type))
+        entry = self.get(key)
+        hashes = {}
+        if entry is not None and entry[0] == stamp:
+            p_hash = entry[1].get(variant)
+            if p_hash is not None:
+                return p_hash
+            hashes = dict(entry[1])
+        hashes[variant] = p_hash = compute()
+        self.set(key, (stamp, hashes))
+        return p_hash
+
+
+payload_hash_cache = PayloadHashCache()
+
+
+class VerifyingReader(object):
+    """File-like wrapper which hashes a stream while it is read.
+
+    Everything read passes through hasher. Once the stream is exhausted,
+    or length bytes were read, the payload hash is compared with expected
+    and InvalidPayloadHash is raised on mismatch. Nothing is buffered.
+
+    :param stream: object with a read method
+    :param hasher: a PayloadHasher
+    :param expected: base64 payload hash the stream must match
+    :param length: number of bytes to read, None reads until EOF
+    """
+
+    def __init__(self, stream, hasher, expected, length=None):
+        self.stream = stream
+        self.hasher = hasher
+        self.expected = expected
+        self.remaining = length
+        self.verified = False
+
+    def _limit(self, size):
+        """Caps a read size at the remaining length."""
+        if self.remaining is None:
+            return size
+        if size is None or size < 0 or size > self.remaining:
+            return self.remaining
+        return size
+
+    def _feed(self, data):
+        """Hashes data and verifies once the end is reached."""
+        if data:
+            self.hasher.update(data)
+            if self.remaining is not None:
+                self.remaining -= len(data)
+        if not data or self.remaining == 0:
+            self._verify()
+        return data
+
+    def _verify(self):
+        """Compares the payload hash with the expected one."""
+        if self.verified:
+            return
+        if not compare(self.hasher.finalize(), self.expected):
+            log.info("Streamed payload hash mismatch")
+            raise InvalidPayloadHash
+        self.verified = True
+
+    def read(self, size=-1):
+        """Reads and hashes up to size bytes."""
+        size = self._limit(size)
+        if size == 0:
+            return self._feed('') if self.remaining == 0 else ''
+        if size is None or size < 0:
+            return self._feed(self.stream.read())
+        return self._feed(self.stream.read(size))
+
+    def readline(self, size=-1):
+        """Reads and hashes one line."""
+        size = self._limit(size)
+        if size == 0:
+            return self._feed('') if self.remaining == 0 else ''
+        if size is None or size < 0:
+            return self._feed(self.stream.readline())
+        return self._feed(self.stream.readline(size))
+
+    def readlines(self, hint=-1):
+        """Reads and hashes the remaining lines."""
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Returns the next line."""
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def drain(self):
+        """Reads, hashes and discards the rest of the stream."""
+        while not self.verified:
+            self.read(PayloadHasher.chunk_size)
 
 
 def parse_content_type(content_type):
@@ -105,8 +461,8 @@ def parse_content_type(content_type):
 def calculate_ts_mac(ts, credentials):
     """Calculates a timestamp message authentication code for HAWK."""
     data = 'hawk.' + str(HAWK_VER) + '.ts\n' + ts + '\n'
-    digestmod = module_for_algorithm(credentials['algorithm'])
-    result = hmac.new(credentials['key'], data, digestmod)
+    result = key_cache.hmac_for(credentials)
+    result.update(data)
     return b64encode(result.digest())
 
 
@@ -117,6 +473,80 @@ def random_string(length):
     return urlsafe_b64encode(os.urandom(length))[:length]
 
 
+class NonceGenerator(object):
+    """Thread safe source of random nonces, drawn from buffered entropy.
+
+    Instead of one os.urandom call per nonce, entropy is read in blocks of
+    block_size bytes and base64 encoded at once; nonces are consecutive,
+    never reused slices of that text. Each character carries 6 random
+    bits, so a 6 character nonce has the same 36 bits as
+    random_string(6). When less than a quarter of a block is left the
+    next block is read on a background thread.
+
+    Security notes: all randomness still comes from os.urandom. Nonces
+    only have to be unique, not secret, but upcoming nonces sit in memory
+    until used. A forked child would otherwise repeat its parent's
+    nonces, so the buffer is discarded whenever the process id changes.
+    """
+
+    def __init__(self, block_size=48 * 1024, background=True):
+        # A multiple of 3 bytes encodes to base64 without padding
+        self.block_size = block_size - block_size % 3
+        self.background = background
+        self._lock = threading.Lock()
+        self._pid = None
+        self._buffer = ''
+        self._pos = 0
+        self._next = None
+        self._refilling = False
+
+    def _draw(self):
+        """Reads and encodes one block of entropy."""
+        return urlsafe_b64encode(os.urandom(self.block_size))
+
+    def __call__(self, length=6):
+        """Returns a nonce of length characters."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: never hand out what the parent may also use
+                self._pid = os.getpid()
+                self._buffer = ''
+                self._pos = 0
+                self._next = None
+                self._refilling = False
+
+            if self._pos + length > len(self._buffer):
+                self._buffer = self._next or self._draw()
+                self._next = None
+                self._pos = 0
+                if length > len(self._buffer):
+                    return random_string(length)
+
+            nonce = self._buffer[self._pos:self._pos + length]
+            self._pos += length
+
+            if self.background and self._next is None and \
+                    not self._refilling and \
+                    len(self._buffer) - self._pos < len(self._buffer) // 4:
+                self._refilling = True
+                refill = threading.Thread(target=self._refill,
+                                          args=(self._pid,))
+                refill.daemon = True
+                refill.start()
+        return nonce
+
+    def _refill(self, pid):
+        """Prepares the next block, run on a background thread."""
+        block = self._draw()
+        with self._lock:
+            if self._pid == pid:
+                self._next = block
+                self._refilling = False
+
+
+nonce_generator = NonceGenerator()
+
+
 def calculate_bewit(credentials, artifacts, exp):
     """Calculates mac and formats a string for the bewit."""
     mac = calculate_mac('bewit', credentials, artifacts, True)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Instrumentation hooks for HAWK verification.
+
+Install an Instrumentation to receive the time spent in each phase of
+Server/Authenticator verification and counters of outcomes:
+
+    collector = hawk.instrument.HistogramCollector()
+    hawk.instrument.install(collector)
+    ...
+    print hawk.instrument.prometheus_text(collector)
+
+Phases are 'header_parse', 'credentials', 'mac', 'payload_hash', 'nonce',
+'skew' and 'nonce_record'. Requests are counted as 'authenticated' or
+'rejected', and 'rejected.<stage>' names the verification stage which
+rejected them. With no hooks installed the verification path only pays
+for a truth test of the hooks list.
+"""
+
+import threading
+import time
+
+# Installed hooks, tested on the hot path before any timing is done.
+hooks = []
+
+PHASES = ('header_parse', 'credentials', 'mac', 'payload_hash', 'nonce',
+          'skew', 'nonce_record')
+
+DEFAULT_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+class Instrumentation(object):
+    """Base class for hooks, override the methods of interest."""
+
+    def observe(self, phase, seconds):
+        """Called with the duration of a verification phase."""
+        pass
+
+    def count(self, event, value=1):
+        """Called when an event, e.g. 'authenticated', happens."""
+        pass
+
+
+def install(hook):
+    """Starts sending timings and counters to hook."""
+    if hook not in hooks:
+        hooks.append(hook)
+
+
+def uninstall(hook):
+    """Stops sending timings and counters to hook."""
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+def clock():
+    """Returns the current time, or None when nothing is installed."""
+    if hooks:
+        return time.time()
+    return None
+
+
+def lap(phase, start):
+    """Reports the time since start for phase, returns the current time.
+
+    Does nothing when start is None, i.e. no hook was installed when the
+    timing began.
+    """
+    if start is None:
+        return None
+    now = time.time()
+    for hook in hooks:
+        hook.observe(phase, now - start)
+    return now
+
+
+def count(event, value=1):
+    """Reports an event to every hook."""
+    for hook in hooks:
+        hook.count(event, value)
+
+
+class HistogramCollector(Instrumentation):
+    """Keeps an in-memory histogram per phase and a total per event."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = {
+                    'counts': [0] * len(self.buckets), 'sum': 0.0,
+                    'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    def count(self, event, value=1):
+        with self._lock:
+            self._counters[event] = self._counters.get(event, 0) + value
+
+    def snapshot(self):
+        """Returns a copy of the histograms and counters.
+
+        Histogram counts are per bucket, not cumulative; observations
+        above the largest bucket are only part of 'count'.
+        """
+        with self._lock:
+            histograms = dict(
+                (phase, {'counts': list(h['counts']), 'sum': h['sum'],
+                         'count': h['count']})
+                for phase, h in self._histograms.iteritems())
+            return {'buckets': self.buckets, 'histograms': histograms,
+                    'counters': dict(self._counters)}
+
+    def reset(self):
+        """Forgets every observation."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+def prometheus_text(collector, prefix='hawk'):
+    """Renders a HistogramCollector in the Prometheus text format."""
+    snapshot = collector.snapshot()
+    lines = [
+        '# HELP %s_phase_seconds Time spent per verification phase.'
+        % prefix,
+        '# TYPE %s_phase_seconds histogram' % prefix,
+    ]
+    for phase in sorted(snapshot['histograms']):
+        histogram = snapshot['histograms'][phase]
+        cumulative = 0
+        for bound, bucket_count in zip(snapshot['buckets'],
+                                       histogram['counts']):
+            cumulative += bucket_count
+            lines.append('%s_phase_seconds_bucket{phase="%s",le="%r"} %d'
+                         % (prefix, phase, bound, cumulative))
+        lines.append('%s_phase_seconds_bucket{phase="%s",le="+Inf"} %d'
+                     % (prefix, phase, histogram['count']))
+        lines.append('%s_phase_seconds_sum{phase="%s"} %r'
+                     % (prefix, phase, histogram['sum']))
+        lines.append('%s_phase_seconds_count{phase="%s"} %d'
+                     % (prefix, phase, histogram['count']))
+
+    lines.append('# HELP %s_events_total Verification outcomes.' % prefix)
+    lines.append('# TYPE %s_events_total counter' % prefix)
+    for event in sorted(snapshot['counters']):
+        lines.append('%s_events_total{event="%s"} %d'
+                     % (prefix, event, snapshot['counters'][event]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process nonce replay cache for HAWK authentication.
+"""
+
+import math
+import threading
+import time
+
+
+class _Shard(object):
+    """One independently locked part of a NonceStore."""
+
+    __slots__ = ('lock', 'buckets', 'oldest', 'inserts', 'replays',
+                 'evicted_buckets', 'evicted_entries')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets every entry and zeroes the counters."""
+        # bucket index -> set of (id, nonce, ts)
+        self.buckets = {}
+        self.oldest = None
+        self.inserts = 0
+        self.replays = 0
+        self.evicted_buckets = 0
+        self.evicted_entries = 0
+
+    def expire(self, cutoff):
+        """Drops every bucket with an index below cutoff."""
+        for index in [i for i in self.buckets if i < cutoff]:
+            self.evicted_entries += len(self.buckets.pop(index))
+            self.evicted_buckets += 1
+        self.oldest = min(self.buckets) if self.buckets else None
+
+
+class NonceStore(object):
+    """Remembers (id, nonce, ts) triples seen within the timestamp window.
+
+    Entries are grouped in buckets of window_sec seconds by their ts, so a
+    whole bucket expires at once when it falls out of the window. Memory is
+    bounded by the request rate times the window. Keys are spread over
+    independently locked shards so concurrent checks rarely contend.
+
+    The window is fixed at construction. Checks may use a smaller skew,
+    never a larger one, as entries are only kept for window_sec.
+
+    A NonceStore is used by Server.authenticate unless a check_nonce_fn
+    option is given, see store_for. It can also be passed explicitly as
+    check_nonce_fn.
+
+    :param window_sec: longest timestamp skew checked against the store
+    :param shards: number of independently locked shards
+    """
+
+    def __init__(self, window_sec=60, shards=16):
+        self.window_sec = int(window_sec)
+        self.bucket_sec = self.window_sec
+        self._shards = [_Shard() for _ in range(shards)]
+
+    def __call__(self, nonce, ts):
+        """check_nonce_fn compatible entry point, without a credential id."""
+        return self.check('', nonce, ts)
+
+    def check(self, cid, nonce, ts, skew_sec=None, now=None):
+        """Records a nonce, returns False if it was seen before.
+
+        Timestamps outside of now +/- skew_sec can not be tracked and are
+        rejected as well. Raises ValueError if skew_sec is larger than the
+        window of the store.
+        """
+        if skew_sec is None:
+            skew_sec = self.window_sec
+        elif skew_sec > self.window_sec:
+            raise ValueError('skew of %ss exceeds the %ss nonce window'
+                             % (skew_sec, self.window_sec))
+        if now is None:
+            now = time.time()
+        ts = int(ts)
+        if abs(ts - now) > skew_sec:
+            return False
+
+        key = (cid, nonce, ts)
+        shard = self._shards[hash(key) % len(self._shards)]
+        index = ts // self.bucket_sec
+        cutoff = int(now - self.window_sec) // self.bucket_sec
+        with shard.lock:
+            if shard.oldest is not None and shard.oldest < cutoff:
+                shard.expire(cutoff)
+            bucket = shard.buckets.get(index)
+            if bucket is None:
+                bucket = shard.buckets[index] = set()
+                if shard.oldest is None or index < shard.oldest:
+                    shard.oldest = index
+            elif key in bucket:
+                shard.replays += 1
+                return False
+            bucket.add(key)
+            shard.inserts += 1
+        return True
+
+    def seen(self, cid, nonce, ts):
+        """Returns True if the nonce was recorded, without recording it."""
+        ts = int(ts)
+        key = (cid, nonce, ts)
+        shard = self._shards[hash(key) % len(self._shards)]
+        with shard.lock:
+            bucket = shard.buckets.get(ts // self.bucket_sec)
+            return bucket is not None and key in bucket
+
+    def clear(self):
+        """Forgets every nonce and resets the counters."""
+        for shard in self._shards:
+            with shard.lock:
+                shard.reset()
+
+    def stats(self):
+        """Returns occupancy and eviction counters summed over all shards."""
+        result = dict.fromkeys(['entries', 'buckets', 'inserts', 'replays',
+                                'evicted_buckets', 'evicted_entries'], 0)
+        for shard in self._shards:
+            with shard.lock:
+                result['entries'] += sum(len(b) for b in
+                                         shard.buckets.itervalues())
+                result['buckets'] += len(shard.buckets)
+                result['inserts'] += shard.inserts
+                result['replays'] += shard.replays
+                result['evicted_buckets'] += shard.evicted_buckets
+                result['evicted_entries'] += shard.evicted_entries
+        return result
+
+
+default_store = NonceStore()
+
+# Shared stores for windows longer than the default one, by window
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_for(skew_sec):
+    """Returns the shared store for a timestamp skew of skew_sec.
+
+    Skews up to the default window share default_store. Longer skews get a
+    store whose window is rounded up to a power of two seconds, so a few
+    stores serve every skew and none expires the entries of another.
+    """
+    if skew_sec <= default_store.window_sec:
+        return default_store
+    window = 1 << int(math.ceil(math.log(skew_sec, 2)))
+    store = _stores.get(window)
+    if store is None:
+        with _stores_lock:
+            store = _stores.setdefault(window, NonceStore(window))
+    return store
+
+
+def clear():
+    """Forgets every nonce of the shared stores."""
+    default_store.clear()
+    with _stores_lock:
+        for store in _stores.itervalues():
+            store.clear()
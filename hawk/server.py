@@ -9,14 +9,16 @@ Python library for HAWK
 
 """
 
-import copy
+import hashlib
 import logging
 import math
-import pprint
+import threading
 import time
-from urlparse import urlparse, parse_qs
+from base64 import b64encode
 
 import hawk.hcrypto as hcrypto
+import hawk.instrument as instrument
+import hawk.nonce as nonce
 import hawk.util as util
 
 log = logging.getLogger(__name__)
@@ -32,6 +34,19 @@ class BadRequest(util.HawkException):
     pass
 
 
+class StaleTimestamp(BadRequest):
+    """Exception raised when a request timestamp is outside the skew.
+
+    credentials are None when the request was rejected before they were
+    looked up, id is the credentials id the request claims.
+    """
+
+    def __init__(self, credentials, cid=None):
+        super(StaleTimestamp, self).__init__('Stale timestamp')
+        self.credentials = credentials
+        self.id = cid
+
+
 class MissingCredentials(util.HawkException):
     """Exception raised for bad security configuration."""
     pass
@@ -42,105 +57,415 @@ class BewitExpired(util.HawkException):
     pass
 
 
-class Server(object):
-    """Object with authenticate and header methods."""
-
-    def __init__(self, req, credentials_fn):
-        """Initialize a Server object.
-        :param req: a request object
-        :param credentials_fn:
-            Callback function to lookup a dict of: id, key, algorithm
-        """
-        self.req = req
-        self.credentials_fn = credentials_fn
-
-    def authenticate(self, options):
+# Bewits already verified, see Authenticator.authenticate_bewit
+default_bewit_cache = util.LRUCache(max_size=10000)
+
+# Latest (ts, tsm) per credentials, see Authenticator.timestamp_challenge
+_ts_mac_cache = util.LRUCache(max_size=10000)
+
+# Verification stages, cheapest first, see Authenticator
+DEFAULT_STAGES = ('limits', 'timestamp', 'nonce', 'credentials', 'mac',
+                  'payload')
+
+# Instrumentation phase each stage is timed as
+_STAGE_PHASES = {
+    'limits': 'header_parse',
+    'timestamp': 'skew',
+    'nonce': 'nonce',
+    'credentials': 'credentials',
+    'mac': 'mac',
+    'payload': 'payload_hash',
+}
+
+
+class Authenticator(object):
+    """Reusable HAWK verification policy.
+
+    Build one per process and share it: an Authenticator can not be
+    modified after construction, its methods never modify their arguments
+    and it is safe to call from many threads at once.
+
+    :param credentials_fn:
+        Callback function to lookup a dict of: id, key, algorithm
+    :param timestamp_skew_sec: Allowed clock skew in seconds.
+    :param localtime_offset_msec: Offset for server time.
+    :param check_nonce_fn:
+        Callback taking nonce and ts, returning False for a replay.
+    :param nonce_store:
+        NonceStore used when no check_nonce_fn is given, None disables
+        nonce checks. Its window must cover timestamp_skew_sec. Defaults
+        to the shared nonce.store_for(timestamp_skew_sec).
+    :param require_payload_hash: Reject requests without a payload hash.
+    :param bewit_cache:
+        LRUCache of verified bewits, entries expire with the bewit. None
+        verifies the MAC of every bewit request. A hit only saves the MAC,
+        credentials_fn is still called for every bewit request.
+    :param offload_hash_bytes:
+        Payloads of at least this many bytes are hashed on a shared thread
+        pool while the credentials are looked up and the MAC is checked.
+        None hashes every payload inline, after the MAC.
+    :param hash_algorithm:
+        Algorithm offloaded hashes are computed with before the credentials
+        are known. Requests whose credentials use another algorithm are
+        hashed again inline.
+    :param stages:
+        Order of the verification stages, see below.
+
+    A request passes through stages which each reject it or let it go on:
+
+    - limits: header size and syntax, required attributes
+    - timestamp: ts within timestamp_skew_sec of the server time
+    - nonce: the nonce was not recorded before (only with a nonce_store)
+    - credentials: credentials_fn lookup
+    - mac: the header MAC
+    - payload: the payload hash, and require_payload_hash
+
+    The default order, DEFAULT_STAGES, runs the cheap checks first, so
+    stale and replayed requests are rejected before any lookup or HMAC
+    work. Rejections are counted per stage as 'rejected.<stage>' events,
+    see hawk.instrument. Any order is accepted as long as:
+
+    - limits comes first, the other stages read its attributes.
+    - credentials comes before mac and payload.
+
+    Whatever the order, these invariants hold:
+
+    - Stages never record anything. The nonce is recorded only after
+      every stage passed, so a forged request can not use up the nonce
+      of a genuine one.
+    - Before the mac stage the id, ts and nonce are not authenticated.
+      The stages before it use them only to reject a request.
+    - A request rejected as stale before its MAC was checked may still
+      get a timestamp_challenge. The challenge only signs the server
+      time, which is of no use without the key.
+    - A stale request never causes a credentials_fn lookup, not even for
+      its challenge. stale_challenge signs only with credentials a
+      util.CredentialsCache already holds, other clients get an
+      unsigned error and have to fix their clock on their own.
+    - A custom check_nonce_fn both checks and records. It is only called
+      once every stage passed.
+    """
+
+    __slots__ = ('credentials_fn', 'timestamp_skew_sec',
+                 'localtime_offset_msec', 'check_nonce_fn', 'nonce_store',
+                 'require_payload_hash', 'bewit_cache', 'offload_hash_bytes',
+                 'hash_algorithm', 'stages', '_stages', '_before', '_lookup',
+                 '_after')
+
+    def __init__(self, credentials_fn, timestamp_skew_sec=60,
+                 localtime_offset_msec=0, check_nonce_fn=None,
+                 nonce_store=nonce.default_store,
+                 require_payload_hash=False,
+                 bewit_cache=default_bewit_cache, offload_hash_bytes=None,
+                 hash_algorithm='sha256', stages=DEFAULT_STAGES):
+        init = super(Authenticator, self).__setattr__
+        init('credentials_fn', credentials_fn)
+        init('timestamp_skew_sec', int(timestamp_skew_sec))
+        init('localtime_offset_msec', int(localtime_offset_msec))
+        init('check_nonce_fn', check_nonce_fn)
+        if nonce_store is nonce.default_store:
+            nonce_store = nonce.store_for(self.timestamp_skew_sec)
+        elif nonce_store is not None and \
+                nonce_store.window_sec < self.timestamp_skew_sec:
+            raise ValueError('nonce_store window is shorter than '
+                             'timestamp_skew_sec')
+        init('nonce_store', nonce_store)
+        init('require_payload_hash', require_payload_hash)
+        init('bewit_cache', bewit_cache)
+        init('offload_hash_bytes', offload_hash_bytes)
+        init('hash_algorithm', hash_algorithm)
+
+        stages = tuple(stages)
+        init('stages', stages)
+        before, lookup, after = _bind_stages(type(self), stages)
+        init('_stages', before + lookup + after)
+        init('_before', before)
+        init('_lookup', lookup)
+        init('_after', after)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Authenticator is immutable')
+
+    @classmethod
+    def from_options(cls, credentials_fn, options):
+        """Builds an Authenticator from Server.authenticate style options."""
+        kwargs = {}
+        if 'timestampSkewSec' in options:
+            kwargs['timestamp_skew_sec'] = options['timestampSkewSec']
+        if 'localtimeOffsetMsec' in options:
+            kwargs['localtime_offset_msec'] = options['localtimeOffsetMsec']
+        if 'check_nonce_fn' in options:
+            kwargs['check_nonce_fn'] = options['check_nonce_fn']
+            kwargs['nonce_store'] = None
+        if 'offloadHashBytes' in options:
+            kwargs['offload_hash_bytes'] = options['offloadHashBytes']
+        return cls(credentials_fn, **kwargs)
+
+    def _now(self):
+        """Returns the current server time in seconds."""
+        return math.floor(time.time() + self.localtime_offset_msec / 1000.0)
+
+    def authenticate(self, req, payload=None):
+        """Authenticates a request, returns its artifacts.
+
+        :param req: a request dict, see Server
+        :param payload: The body, or a hcrypto.PayloadHasher which was fed
+                        the body while it was being read. None skips the
+                        payload check.
         """
-        options can have the following
-        * checkNonceFn - A callback to validate if a given nonce is valid
-        * timestampSkewSec - Allows for clock skew in seconds. Defaults to 60.
-        * localtimeOffsetMsec - Offset for client time. Defaults to 0.
-        * options.payload - Required
-
+        check = _Check(req, payload, self._now())
+
+        try:
+            self._run(self._stages, check)
+            self._record_nonce(check)
+        except util.HawkException:
+            instrument.count('rejected')
+            raise
+
+        instrument.count('authenticated')
+        return check.artifacts
+
+    def authenticate_many(self, reqs, credentials_many_fn=None,
+                          parallel_hash_bytes=1024 * 1024):
+        """Authenticate a batch of requests.
+
+        :param reqs: a list of request dicts, as given to Server(). A request
+            may carry its body under the 'payload' key.
+        :param credentials_many_fn:
+            Optional callback taking a list of ids and returning a dict of
+            id to credentials. Replaces credentials_fn for the batch.
+        :param parallel_hash_bytes:
+            Payloads of at least this many bytes are hashed on a thread pool,
+            None hashes every payload inline. Single CPU hosts always hash
+            inline, the hop to the pool would only add overhead there.
+
+        Each credential id is looked up once per batch, after the stages
+        before credentials rejected what they could. Returns a list with
+        one dict per request, in order, holding either 'artifacts' or the
+        exception it was rejected with under 'error', usually a
+        HawkException or lookup error. An unexpected error, e.g. from a
+        payload hashed on the pool, only fails its own request.
         """
-        now = math.floor(time.time())
-
-        self._check_options(options)
-
+        now = self._now()
+        results = [{'artifacts': None, 'error': None} for _ in reqs]
+
+        checks = []
+        for i, req in enumerate(reqs):
+            check = _Check(req, req.get('payload'), now)
+            try:
+                self._run(self._before, check)
+            except Exception as exc:  # pylint: disable=W0703
+                results[i]['error'] = exc
+                continue
+            checks.append((i, check))
+
+        ids = list(set(check.attributes['id'] for _, check in checks))
+        start = instrument.clock()
+        found, failed = _lookup_credentials(ids, self.credentials_fn,
+                                            credentials_many_fn)
+        instrument.lap('credentials', start)
+
+        looked_up = []
+        for i, check in checks:
+            cid = check.attributes['id']
+            if cid in failed:
+                instrument.count('rejected.credentials')
+                results[i]['error'] = failed[cid]
+                continue
+            check.credentials = found[cid]
+            # Large payloads are hashed concurrently, hashlib releases the GIL
+            if 'algorithm' in check.credentials and \
+                    parallel_hash_bytes is not None and \
+                    _payload_size(check.payload) >= parallel_hash_bytes and \
+                    _cpu_count() > 1:
+                check.pending_hash = _start_payload_hash(
+                    check.payload, check.credentials['algorithm'],
+                    check.req.get('contentType'))
+            looked_up.append((i, check))
+
+        for i, check in looked_up:
+            try:
+                _check_credentials(check.credentials)
+                self._run(self._after, check)
+                self._record_nonce(check)
+            except Exception as exc:  # pylint: disable=W0703
+                results[i]['error'] = exc
+                continue
+            results[i]['artifacts'] = check.artifacts
+
+        if instrument.hooks:
+            # Counted like authenticate() counts single requests
+            for result in results:
+                if result['artifacts'] is not None:
+                    instrument.count('authenticated')
+                elif isinstance(result['error'], util.HawkException):
+                    instrument.count('rejected')
+        return results
+
+    def _run(self, stages, check):
+        """Runs check through stages, counting the one which rejects it."""
+        if not instrument.hooks:
+            for _, stage in stages:
+                stage(self, check)
+            return
+        for name, stage in stages:
+            start = instrument.clock()
+            try:
+                stage(self, check)
+            except Exception:
+                instrument.count('rejected.' + name)
+                raise
+            instrument.lap(_STAGE_PHASES[name], start)
+
+    def _limits(self, check):
+        """Parses the header, rejects it without the required attributes."""
         attributes = util.parse_authorization_header(
-            self.req['headers']['authorization'])
+            check.req['headers']['authorization'])
+        for key in ('id', 'ts', 'nonce', 'mac'):
+            if not attributes.get(key):
+                log.info("Missing %s attribute", key)
+                raise BadRequest
+        if not attributes['ts'].isdigit():
+            log.info("Bad ts attribute")
+            raise BadRequest
+        check.attributes = attributes
+        check.artifacts = prepare_artifacts(check.req, attributes)
+        log.debug('artifacts=%r', check.artifacts)
+
+    def _timestamp(self, check):
+        """Rejects a ts outside of the allowed skew."""
+        if math.fabs(int(check.attributes['ts']) - check.now) > \
+                self.timestamp_skew_sec:
+            log.info("Expired request")
+            raise StaleTimestamp(check.credentials, check.attributes['id'])
+
+    def _nonce(self, check):
+        """Rejects a nonce the nonce_store has seen, without recording it."""
+        if self.check_nonce_fn is not None or self.nonce_store is None:
+            return
+        attributes = check.attributes
+        if self.nonce_store.seen(attributes['id'], attributes['nonce'],
+                                 attributes['ts']):
+            log.info("Replayed nonce")
+            raise BadRequest
 
-        artifacts = self._prepare_artifacts(attributes)
+    def _credentials(self, check):
+        """Looks up the credentials of the request."""
+        attributes = check.attributes
+        # The offloaded hash runs during the lookup and the MAC
+        if self.offload_hash_bytes is not None and \
+                'hash' in attributes and \
+                _payload_size(check.payload) >= self.offload_hash_bytes:
+            check.pending_hash = _start_payload_hash(
+                check.payload, self.hash_algorithm,
+                check.req.get('contentType'))
+        check.credentials = self.credentials_fn(attributes['id'])
+        _check_credentials(check.credentials)
+
+    def _mac(self, check):
+        """Rejects a header MAC which does not match."""
+        mac = hcrypto.mac_digest('header', check.credentials, check.artifacts)
+        theirs = hcrypto.decode_mac(check.attributes['mac'])
+        if theirs is None or not util.compare(mac, theirs):
+            log.info("Ours [%s] Theirs [%s]", b64encode(mac),
+                     check.attributes['mac'])
+            raise BadMac
 
-        log.debug('artifacts=%s' % pprint.pformat(artifacts))
+    def _payload(self, check):
+        """Rejects a missing or wrong payload hash.
 
-        credentials = self.credentials_fn(attributes['id'])
-        mac = self._calculate_mac(credentials, artifacts)
+        A pending hash started by the credentials stage is waited for
+        here.
+        """
+        attributes = check.attributes
+        if self.require_payload_hash and 'hash' not in attributes:
+            log.info("Missing required payload hash")
+            raise BadRequest
 
-        if not util.compare(mac, attributes['mac']):
-            log.info("Ours [" + mac + "] Theirs [" + attributes['mac'] + "]")
-            raise BadMac
+        if check.payload is None:
+            return
+        if 'hash' not in attributes:
+            log.info("Missing required payload hash")
+            raise BadRequest
+        algorithm = check.credentials['algorithm']
+        content_type = check.req.get('contentType')
+        p_hash = None
+        if check.pending_hash is not None and \
+                check.pending_hash[0] == algorithm:
+            p_hash = check.pending_hash[1].get()
+        if p_hash is None:
+            p_hash = hcrypto.calculate_payload_hash(check.payload, algorithm,
+                                                    content_type)
+        log.debug('payload=%r', check.payload)
+        log.debug('algorithm=%s, contentType=%s', algorithm, content_type)
+        if not util.compare(p_hash, attributes['hash']):
+            log.info("Bad payload hash")
+            raise BadRequest
 
-        if 'payload' in options:
-            if 'hash' not in attributes:
-                log.info("Missing required payload hash")
+    def _record_nonce(self, check):
+        """Records the nonce once every stage passed."""
+        start = instrument.clock()
+        attributes = check.attributes
+        if self.check_nonce_fn is not None:
+            if not self.check_nonce_fn(attributes['nonce'], attributes['ts']):
+                instrument.count('rejected.nonce')
                 raise BadRequest
-            p_hash = hcrypto.calculate_payload_hash(options['payload'],
-                                                    credentials['algorithm'],
-                                                    self.req['contentType'])
-            log.debug('payload=%s' % options['payload'])
-            log.debug('algorithm=%s, contentType=%s'
-                      % (credentials['algorithm'], self.req['contentType']))
-            if not util.compare(p_hash, attributes['hash']):
-                log.info("Bad payload hash")
-                raise BadRequest
-
-        if 'check_nonce_fn' in options:
-            if not options['check_nonce_fn'](attributes['nonce'],
-                                             attributes['ts']):
+        elif self.nonce_store is not None:
+            if not self.nonce_store.check(attributes['id'],
+                                          attributes['nonce'],
+                                          attributes['ts'],
+                                          self.timestamp_skew_sec, check.now):
+                log.info("Replayed nonce")
+                instrument.count('rejected.nonce')
                 raise BadRequest
+        instrument.lap('nonce_record', start)
 
-        skew = int(options['timestampSkewSec'])
-        if math.fabs(int(attributes['ts']) - now) > skew:
-            log.info("Expired request")
-            raise BadRequest
+        check.artifacts.credentials = check.credentials
 
-        return artifacts
-
-    def _calculate_mac(self, credentials, artifacts):
-        """Checks inputs and calculates MAC."""
-        if 'key' not in credentials or 'algorithm' not in credentials:
-            raise MissingCredentials
+    def stale_challenge(self, exc):
+        """Returns the timestamp_challenge for a StaleTimestamp.
 
-        mac = hcrypto.calculate_mac('header', credentials, artifacts)
+        If the request was rejected before its credentials were looked up,
+        they are only taken from a credentials_fn which is a
+        util.CredentialsCache, and only if it holds them already. Returns
+        None when the credentials are unknown or not cached.
+        """
+        credentials = exc.credentials
+        if credentials is None:
+            peek = getattr(self.credentials_fn, 'peek', None)
+            if peek is None:
+                return None
+            credentials = peek(exc.id)
+        if not credentials or 'key' not in credentials or \
+                'algorithm' not in credentials:
+            return None
+        return self.timestamp_challenge(credentials)
 
-        return mac
+    def timestamp_challenge(self, credentials, error='Stale timestamp'):
+        """Returns a WWW-Authenticate header with the signed server time.
 
-    def _prepare_artifacts(self, attributes):
-        """Converts the request and attributes into an artifacts dict."""
-        artifacts = {
-            'method': self.req['method'],
-            'host': self.req['host'],
-            'port': self.req['port'],
-            'resource': util.parse_normalized_url(self.req['url'])['resource'],
-        }
-        artifact_keys = ['ts', 'nonce', 'hash', 'ext',
-                         'app', 'dlg', 'mac', 'id']
-
-        attrs = attributes.keys()
-        for key in artifact_keys:
-            if key in attrs:
-                artifacts[key] = attributes[key]
-            else:
-                # I think we want empty strings in normalized header mac
-                artifacts[key] = ''
-        return artifacts
+        Send it with the 401 for a StaleTimestamp, the client then knows
+        its clock offset. The ts MAC is computed once per second for each
+        credentials.
+        """
+        now = int(self._now())
+        cache_key = (credentials.get('id'), _key_digest(credentials['key']),
+                     credentials['algorithm'])
+        cached = _ts_mac_cache.get(cache_key)
+        if cached is not None and cached[0] == now:
+            tsm = cached[1]
+        else:
+            tsm = hcrypto.calculate_ts_mac(str(now), credentials)
+            _ts_mac_cache.set(cache_key, (now, tsm))
+        return 'Hawk ts="%d", tsm="%s", error="%s"' % (
+            now, tsm, util.check_header_attribute(error))
 
     def header(self, artifacts, options=None):
         """Generate a Server-Authorization header for a given response.
 
         :param artifacts: A dict received from authenticate(). Contains the
-                          following keys 'mac', 'hash', and 'ext'.
+                          following keys 'mac', 'hash', and 'ext'. The
+                          credentials it was verified with are reused.
 
         :param options:
             A dict with the following structure:
@@ -150,7 +475,15 @@ class Server(object):
 
             - payload: '{"some":"payload"}',
                 UTF-8 encoded string for body hash generation (ignored if hash
-                provided).
+                provided). May also be a hcrypto.PayloadHasher.
+
+            - payloadFile: '/srv/static/logo.png',
+                Path of a file sent as the body, instead of payload. Its hash
+                is cached until the file's mtime or size changes.
+
+            - contentKey: '"etag-1234"',
+                Caches the hash of payload under this key, e.g. an ETag,
+                which must change whenever the body does.
 
             - contentType: 'application/json',
                 Payload content-type (ignored if hash provided)
@@ -158,112 +491,339 @@ class Server(object):
             - hash: 'U4MKKSmiVxk37JCCrAVIjV='
                 Pre-calculated payload hash
         }
+
+        Cached hashes are kept in hcrypto.payload_hash_cache.
         """
         if options is None:
             options = {}
 
-        if not artifacts or False == isinstance(artifacts, dict) or \
-                False == isinstance(options, dict):
+        if not isinstance(artifacts, (dict, util.Artifacts)) or \
+                not artifacts or not isinstance(options, dict):
             return ''
 
-        h_artifacts = copy.copy(artifacts)
-        del h_artifacts['mac']
-
-        h_artifacts['hash'] = options.get('hash', None)
-
+        p_hash = options.get('hash') or ''
         if 'ext' in options:
-            h_artifacts['ext'] = options['ext']
-
-        credentials = self.credentials_fn(h_artifacts['id'])
+            ext = options['ext']
+        else:
+            ext = artifacts.get('ext')
+
+        # Reuse the credentials authenticate() verified the request with
+        credentials = getattr(artifacts, 'credentials', None)
+        if not credentials:
+            credentials = self.credentials_fn(artifacts['id'])
         if not credentials or 'key' not in credentials or \
                 'algorithm' not in credentials:
             return ''
 
-        if 'hash' not in h_artifacts or h_artifacts['hash'] is None or \
-                len(h_artifacts['hash']) == 0:
-            if 'payload' in options:
-                h_artifacts['hash'] = hcrypto.calculate_payload_hash(
-                    options['payload'], credentials['algorithm'],
-                    options['contentType'])
+        if not p_hash:
+            p_hash = _response_payload_hash(options, credentials['algorithm'])
 
-        mac = hcrypto.calculate_mac('response', credentials, h_artifacts)
+        mac = hcrypto.calculate_response_mac(credentials, artifacts, p_hash,
+                                             ext)
 
         header = 'Hawk mac="' + mac + '"'
-        if 'hash' in h_artifacts:
-            header += ', hash="' + h_artifacts['hash'] + '"'
-
-        if 'ext' in h_artifacts and h_artifacts['ext'] is not None and \
-                len(h_artifacts['ext']) > 0:
+        if p_hash:
+            header += ', hash="' + p_hash + '"'
 
+        if ext:
             h_ext = util.check_header_attribute(
-                h_artifacts['ext']).replace('\\', '\\\\').replace('\n', '\\n')
+                ext).replace('\\', '\\\\').replace('\n', '\\n')
 
             header += ', ext="' + h_ext + '"'
 
         return header
 
-    def _check_options(self, options):
-        """Provides defaults for options."""
-        if 'timestampSkewSec' not in options:
-            options['timestampSkewSec'] = 60
-
-        if 'localtimeOffsetMsec' not in options:
-            options['localtimeOffsetMsec'] = 0
-
-    def authenticate_bewit(self, options):
+    def authenticate_bewit(self, req):
         """Authenticate bewit one time requests.
 
-        Compatibility Note: HAWK exposes this as hawk.uri.authenticate
-
-        :param options:
-            A dict which may contain the 'hostHeaderName' and
-            'localtimeOffsetMsec' keys.
-
+        Returns True, or False if the request has no bewit.
         """
-        if not valid_bewit_args(self.req, options):
-            return False
-        now = time.time() + int(options['localtime_offset_msec'])
+        valid_bewit_args(req)
+        now = time.time() + self.localtime_offset_msec / 1000.0
 
-        url = urlparse(self.req['url'])
-        qs = parse_qs(url.query)
-
-        if not 'bewit' in qs or len(qs['bewit']) != 1 or \
-                len(qs['bewit'][0]) == 0:
+        bewit_value, original_url = util.extract_bewit(req['url'])
+        if bewit_value is None:
             log.info("No bewit query string parameter")
             return False
 
-        bewit = hcrypto.explode_bewit(qs['bewit'][0])
-
-        original_url = normalize_url_without_bewit(self.req['url'],
-                                                   qs['bewit'][0])
+        bewit = hcrypto.explode_bewit(bewit_value)
 
         if bewit['exp'] < now:
             raise BewitExpired
 
-        options['ts'] = bewit['exp']
+        if not original_url.startswith('/'):
+            original_url = util.parse_normalized_url(original_url)['resource']
+
+        credentials = self.credentials_fn(bewit['id'])
+        if not credentials or 'key' not in credentials or \
+                'algorithm' not in credentials:
+            raise MissingCredentials
+
+        # Entries include a digest of the key, so a rotated key never
+        # matches, without keeping the key itself in a shared cache
+        cache_key = (bewit_value, req['host'], str(req['port']),
+                     original_url, _key_digest(credentials['key']),
+                     credentials['algorithm'])
+        if self.bewit_cache is not None and self.bewit_cache.get(cache_key):
+            return True
 
         artifacts = {
             'ts': bewit['exp'],
             'nonce': '',
             'method': 'GET',
             'resource': original_url,
-            'host': self.req['host'],
-            'port': self.req['port'],
+            'host': req['host'],
+            'port': req['port'],
             'ext': bewit['ext']
         }
 
-        credentials = self.credentials_fn(bewit['id'])
         mac = hcrypto.calculate_mac('bewit', credentials, artifacts, True)
 
         if not util.compare(mac, bewit['mac']):
-            log.info("bewit " + mac + " didn't match " + bewit['mac'])
+            log.info("bewit %s didn't match %s", mac, bewit['mac'])
             raise BadRequest
 
+        if self.bewit_cache is not None:
+            self.bewit_cache.set(cache_key, True, bewit['exp'] - now)
+
         return True
 
 
-def valid_bewit_args(req, options):
-    """Validates inputs and sets defaults for options."""
+class Server(object):
+    """Object with authenticate and header methods for one request.
+
+    Each call builds an Authenticator from its options, use an
+    Authenticator directly to share one policy between requests.
+    """
+
+    def __init__(self, req, credentials_fn):
+        """Initialize a Server object.
+        :param req: a request object
+        :param credentials_fn:
+            Callback function to lookup a dict of: id, key, algorithm
+        """
+        self.req = req
+        self.credentials_fn = credentials_fn
+
+    def authenticate(self, options):
+        """
+        options can have the following
+        * check_nonce_fn - A callback to validate if a given nonce is valid.
+          Defaults to the shared nonce.store_for(timestampSkewSec), None
+          disables nonce checks.
+        * timestampSkewSec - Allows for clock skew in seconds. Defaults to 60.
+        * localtimeOffsetMsec - Offset for server time. Defaults to 0.
+        * options.payload - Required. The body, or a hcrypto.PayloadHasher
+          which was fed the body while it was being read.
+
+        """
+        authenticator = Authenticator.from_options(self.credentials_fn,
+                                                   options)
+        return authenticator.authenticate(self.req, options.get('payload'))
+
+    @classmethod
+    def authenticate_many(cls, reqs, credentials_fn, options=None,
+                          credentials_many_fn=None,
+                          parallel_hash_bytes=1024 * 1024):
+        """Authenticate a batch of requests.
+
+        :param credentials_fn: Callback to lookup credentials for one id.
+        :param options: shared options, see authenticate()
+
+        See Authenticator.authenticate_many for the other arguments and the
+        result.
+        """
+        authenticator = Authenticator.from_options(credentials_fn,
+                                                   options or {})
+        return authenticator.authenticate_many(reqs, credentials_many_fn,
+                                               parallel_hash_bytes)
+
+    def header(self, artifacts, options=None):
+        """Generate a Server-Authorization header for a given response.
+
+        See Authenticator.header.
+        """
+        return Authenticator(self.credentials_fn).header(artifacts, options)
+
+    def timestamp_challenge(self, credentials, options=None):
+        """Returns a WWW-Authenticate header with the signed server time.
+
+        See Authenticator.timestamp_challenge, options may contain
+        localtimeOffsetMsec.
+        """
+        authenticator = Authenticator.from_options(self.credentials_fn,
+                                                   options or {})
+        return authenticator.timestamp_challenge(credentials)
+
+    def authenticate_bewit(self, options):
+        """Authenticate bewit one time requests.
+
+        Compatibility Note: HAWK exposes this as hawk.uri.authenticate
+
+        :param options:
+            A dict which may contain the 'localtime_offset_msec' key.
+
+        """
+        authenticator = Authenticator(
+            self.credentials_fn,
+            localtime_offset_msec=options.get('localtime_offset_msec') or 0)
+        return authenticator.authenticate_bewit(self.req)
+
+
+def _key_digest(key):
+    """Returns a SHA-256 digest standing in for key in cache keys."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).digest()
+
+
+def _check_credentials(credentials):
+    """Raises MissingCredentials unless credentials can calculate a MAC."""
+    if not credentials or 'key' not in credentials or \
+            'algorithm' not in credentials:
+        raise MissingCredentials
+
+
+def prepare_artifacts(req, attributes):
+    """Converts the request and attributes into an Artifacts."""
+    # Missing attributes are empty strings in the normalized header mac
+    get = attributes.get
+    return util.Artifacts(
+        method=req['method'], host=req['host'], port=req['port'],
+        resource=util.parse_normalized_url(req['url'])['resource'],
+        ts=get('ts', ''), nonce=get('nonce', ''), hash=get('hash', ''),
+        ext=get('ext', ''), app=get('app', ''), dlg=get('dlg', ''),
+        mac=get('mac', ''), id=get('id', ''))
+
+
+_payload_pool_instance = None
+_payload_pool_lock = threading.Lock()
+_cpus = None
+
+
+def _cpu_count():
+    """Returns the number of CPUs, looked up once."""
+    global _cpus  # pylint: disable=W0603
+    if _cpus is None:
+        # Imported here, multiprocessing is slow to import
+        from multiprocessing import cpu_count
+        _cpus = cpu_count()
+    return _cpus
+
+
+def _payload_pool():
+    """Returns the thread pool shared for payload hashing."""
+    global _payload_pool_instance  # pylint: disable=W0603
+    if _payload_pool_instance is None:
+        with _payload_pool_lock:
+            if _payload_pool_instance is None:
+                # Imported here, multiprocessing is slow to import and
+                # only needed once a large payload shows up
+                from multiprocessing.pool import ThreadPool
+                _payload_pool_instance = ThreadPool(_cpu_count())
+    return _payload_pool_instance
+
+
+def _response_payload_hash(options, algorithm):
+    """Returns the payload hash Server.header options ask for, or ''."""
+    content_type = options.get('contentType')
+    if 'payloadFile' in options:
+        return hcrypto.payload_hash_cache.hash_file(
+            options['payloadFile'], algorithm, content_type)
+    if 'payload' not in options:
+        return ''
+    if options.get('contentKey') is not None:
+        return hcrypto.payload_hash_cache.hash_payload(
+            options['contentKey'], options['payload'], algorithm,
+            content_type)
+    return hcrypto.calculate_payload_hash(options['payload'], algorithm,
+                                          content_type)
+
+
+# (class, stages) -> stage methods before, at and after credentials
+_bound_stages = {}
+
+
+def _bind_stages(cls, stages):
+    """Validates an order of stages and looks up their methods once."""
+    bound = _bound_stages.get((cls, stages))
+    if bound is not None:
+        return bound
+    if sorted(stages) != sorted(DEFAULT_STAGES) or \
+            stages[0] != 'limits' or \
+            stages.index('credentials') > stages.index('mac') or \
+            stages.index('credentials') > stages.index('payload'):
+        raise ValueError('Invalid verification stages %r' % (stages,))
+    methods = [(name, getattr(cls, '_' + name)) for name in stages]
+    split = stages.index('credentials')
+    bound = (tuple(methods[:split]), (methods[split],),
+             tuple(methods[split + 1:]))
+    _bound_stages[(cls, stages)] = bound
+    return bound
+
+
+class _Check(object):
+    """A request on its way through the verification stages."""
+
+    __slots__ = ('req', 'payload', 'now', 'attributes', 'artifacts',
+                 'credentials', 'pending_hash')
+
+    def __init__(self, req, payload, now):
+        self.req = req
+        self.payload = payload
+        self.now = now
+        self.attributes = None
+        self.artifacts = None
+        self.credentials = None
+        self.pending_hash = None
+
+
+def _payload_size(payload):
+    """Returns the length of a payload which can be hashed off-thread."""
+    if payload is None or isinstance(payload, hcrypto.PayloadHasher):
+        return -1
+    try:
+        return len(payload)
+    except TypeError:
+        return -1
+
+
+def _start_payload_hash(payload, algorithm, content_type):
+    """Starts hashing payload on the shared pool.
+
+    Returns the algorithm and the pending result.
+    """
+    return (algorithm, _payload_pool().apply_async(
+        hcrypto.calculate_payload_hash, (payload, algorithm, content_type)))
+
+
+def _lookup_credentials(ids, credentials_fn, credentials_many_fn=None):
+    """Looks up credentials for each id once.
+
+    Returns a tuple of a dict of found credentials and a dict of errors,
+    both keyed by id.
+    """
+    found = {}
+    failed = {}
+    if credentials_many_fn is not None:
+        try:
+            found = credentials_many_fn(ids) or {}
+        except Exception as exc:  # pylint: disable=W0703
+            return {}, dict((cid, exc) for cid in ids)
+    else:
+        for cid in ids:
+            try:
+                found[cid] = credentials_fn(cid)
+            except Exception as exc:  # pylint: disable=W0703
+                failed[cid] = exc
+    for cid in ids:
+        if cid not in failed and not found.get(cid):
+            failed[cid] = MissingCredentials()
+    return found, failed
+
+
+def valid_bewit_args(req, options=None):
+    """Validates the request of a bewit authentication."""
 
     if 'url' not in req or 'method' not in req:
         log.info("missing url or method in request")
@@ -278,18 +838,9 @@ def valid_bewit_args(req, options):
         log.info("ERROR: Attempt to use auth header and bewit")
         raise BadRequest
 
-    if 'localtime_offset_msec' not in options or \
-            options['localtime_offset_msec'] is None:
-        options['localtime_offset_msec'] = 0
-
     return True
 
 
-def normalize_url_without_bewit(url, bewit):
+def normalize_url_without_bewit(url, bewit=None):
     """Normalizes url by removing bewit parameter."""
-    bewit_pos = url.find('bewit=')
-    # Chop off the last character before 'bewit=' which is either a ? or a &
-    bewit_pos -= 1
-    bewit_end = bewit_pos + len("bewit=" + bewit) + 1
-    o_url = ''.join([url[0:bewit_pos], url[bewit_end:]])
-    return o_url
+    return util.extract_bewit(url)[1]
@@ -3,10 +3,19 @@
 
 """Tests for Requests."""
 
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import threading
 import time
 import unittest
+from StringIO import StringIO
 
 import hawk
+import hawk.instrument
+import hawk.wsgi
 
 CREDS = {
     'foobar-1234': {
@@ -23,7 +32,8 @@ class HawkTestCase(unittest.TestCase):
 
     def setUp(self):
         """Create simple data set with headers."""
-        pass
+        hawk.nonce.clear()
+        hawk.client.clock_offsets.clear()
 
     def tearDown(self):
         """Teardown."""
@@ -132,6 +142,13 @@ class HawkTestCase(unittest.TestCase):
 
         assert header == 'Hawk mac="okjCR+o26FMhInYoJ1QO30Fu9cl3wGIWmwqydQXND+w=", hash="y+iZjG+hr2is3SmZLFOe551/LGS3PQPMY9ZWjToaNjg=", ext="and welcome!"'
 
+        # Without a payload the hash attribute is left out
+        header = server.header(artifacts, {})
+        assert 'hash=' not in header
+        assert hawk.client.authenticate(
+            {'headers': {'server-authorization': header}},
+            CREDS['foobar-1234'], artifacts, {'required': True})
+
     def test_parsing_empty_attrs(self):
         url = '/bazz?buzz=fizz&mode=ala'
 
@@ -147,6 +164,824 @@ class HawkTestCase(unittest.TestCase):
         server = hawk.Server(req, lambda cid: CREDS[cid])
         artifacts = server.authenticate({'timestampSkewSec': self._skewed_now()})
 
+    def test_key_cache(self):
+        creds = dict(CREDS['foobar-1234'])
+        cache = hawk.hcrypto.key_cache
+        cache.clear()
+
+        mac = hawk.hcrypto.calculate_ts_mac('1367927332', creds)
+        assert cache.stats()['misses'] == 1
+        assert hawk.hcrypto.calculate_ts_mac('1367927332', creds) == mac
+        assert cache.stats()['hits'] == 1
+
+        # Rotated keys never reuse the old key state
+        creds['key'] = 'another long random string'
+        assert hawk.hcrypto.calculate_ts_mac('1367927332', creds) != mac
+        assert cache.stats()['misses'] == 2
+
+    def test_payload_hasher(self):
+        payload = 'Hello and welcome!'
+        expected = hawk.hcrypto.calculate_payload_hash(payload, 'sha256',
+                                                       'text/plain')
+        assert expected == 'y+iZjG+hr2is3SmZLFOe551/LGS3PQPMY9ZWjToaNjg='
+
+        for source in [StringIO(payload), ['Hello ', 'and ', 'welcome!'],
+                       [bytearray('Hello and '), memoryview('welcome!')]]:
+            hasher = hawk.hcrypto.PayloadHasher('sha256', 'text/plain')
+            assert hasher.update_from(source).finalize() == expected
+
+        hasher = hawk.hcrypto.PayloadHasher('sha256', 'text/plain')
+        hasher.update_from(StringIO(payload))
+        header = hawk.client.header(url, 'POST', {
+            'credentials': CREDS['foobar-1234'], 'payload': hasher})
+        assert header['artifacts']['hash'] == expected
+
+    def test_parse_authorization_header(self):
+        attrs = hawk.util.parse_authorization_header(
+            'Hawk id="foobar-1234", ext="a=b, c=d", mac="ab/c+d=="')
+        assert attrs == {'id': 'foobar-1234', 'ext': 'a=b, c=d',
+                         'mac': 'ab/c+d=='}
+
+        for bad in ['Basic id="foobar-1234"',
+                    'Hawk id="foobar-1234" mac="ab"',
+                    'Hawk id="foobar-1234", id="again"',
+                    'Hawk unknown="foobar-1234"',
+                    'Hawk id="' + 'a' * hawk.util.MAX_HEADER_LENGTH + '"']:
+            self.assertRaises(hawk.util.BadRequest,
+                              hawk.util.parse_authorization_header, bad)
+
+    def test_authenticate_many(self):
+        auth = 'Hawk id="foobar-1234", ts="1367927332", nonce="lwfuar", ext="and welcome!", mac="ZZI/y3M0gV7PWCRX1VddptkWhunWxrpQikXAsLYzblU="'
+        good = {'method': 'GET', 'url': '/bazz?buzz=fizz&mode=ala',
+                'host': 'example.com', 'port': 80,
+                'headers': {'authorization': auth}}
+        bad_mac = dict(good, url='/other')
+        unknown = dict(good, headers={
+            'authorization': auth.replace('foobar-1234', 'unknown')})
+
+        lookups = []
+        def credentials_fn(cid):
+            lookups.append(cid)
+            return CREDS[cid]
+
+        collector = hawk.instrument.HistogramCollector()
+        hawk.instrument.install(collector)
+        try:
+            results = hawk.Server.authenticate_many(
+                [good, bad_mac, unknown, good], credentials_fn,
+                {'timestampSkewSec': self._skewed_now()})
+        finally:
+            hawk.instrument.uninstall(collector)
+        snapshot = collector.snapshot()
+        assert snapshot['histograms']['credentials']['count'] == 1
+        assert snapshot['counters']['authenticated'] == 1
+        assert snapshot['counters']['rejected'] == 2
+        assert snapshot['counters']['rejected.credentials'] == 1
+
+        assert sorted(lookups) == ['foobar-1234', 'unknown']
+        assert results[0]['error'] is None
+        assert results[0]['artifacts']['resource'] == '/bazz?buzz=fizz&mode=ala'
+        assert isinstance(results[1]['error'], hawk.server.BadMac)
+        assert isinstance(results[2]['error'], KeyError)
+        # The same request again is a replay
+        assert isinstance(results[3]['error'], hawk.server.BadRequest)
+
+        # An unexpected error only fails its own request
+        broken = {'id': 'broken', 'key': 'secret', 'algorithm': 'sha256'}
+        reqs = [dict(good, headers={'authorization': hawk.client.header(
+            url, 'GET', {'credentials': creds})['field']})
+            for creds in [broken, CREDS['foobar-1234']]]
+        results = hawk.Server.authenticate_many(
+            reqs,
+            lambda cid: dict(broken, key=None) if cid == 'broken'
+            else CREDS[cid],
+            {'timestampSkewSec': self._skewed_now()})
+        assert isinstance(results[0]['error'], TypeError)
+        assert results[1]['error'] is None
+
+    def test_nonce_store(self):
+        store = hawk.NonceStore(window_sec=60, shards=4)
+        now = 1367927332
+
+        assert store.check('id', 'abc', now, 60, now)
+        assert not store.check('id', 'abc', now, 60, now)
+        assert store.check('other', 'abc', now, 60, now)
+        assert not store.check('id', 'stale', now - 61, 60, now)
+
+        # Two bucket widths later the first entries expire as a whole
+        assert store.check('id', 'abc', now + 120, 60, now + 120)
+        stats = store.stats()
+        assert stats['replays'] == 1
+        assert stats['evicted_entries'] >= 1
+        assert stats['entries'] <= 2
+
+        # Skews beyond the window can not be tracked
+        self.assertRaises(ValueError, store.check, 'id', 'wide', now, 120,
+                          now)
+        self.assertRaises(ValueError, hawk.Authenticator, CREDS.get,
+                          timestamp_skew_sec=120, nonce_store=store)
+
+    def test_nonce_store_skews(self):
+        now = time.time()
+        wide = hawk.Authenticator(CREDS.get, timestamp_skew_sec=3600)
+        narrow = hawk.Authenticator(CREDS.get)
+        assert wide.nonce_store is not narrow.nonce_store
+        assert wide.nonce_store.window_sec >= 3600
+
+        def request(ts, nonce):
+            header = hawk.client.header(url, 'GET', {
+                'credentials': CREDS['foobar-1234'], 'timestamp': ts,
+                'nonce': nonce})
+            return {'method': 'GET', 'url': '/bazz?buzz=fizz&mode=ala',
+                    'host': 'example.com', 'port': 80,
+                    'headers': {'authorization': header['field']}}
+
+        old = request(int(now) - 1800, 'old')
+        wide.authenticate(old)
+        self.assertRaises(hawk.server.BadRequest, wide.authenticate, old)
+        # Traffic through the narrow window must not expire the wide one
+        for i in range(65):
+            narrow.authenticate(request(int(now), 'n%d' % i))
+        self.assertRaises(hawk.server.BadRequest, wide.authenticate, old)
+
+    def test_server_rejects_replay(self):
+        req = {
+            'method': 'GET',
+            'url': '/bazz?buzz=fizz&mode=ala',
+            'host': 'example.com',
+            'port': 80,
+            'headers': {
+                'authorization': 'Hawk id="foobar-1234", ts="1367927332", nonce="lwfuar", ext="and welcome!", mac="ZZI/y3M0gV7PWCRX1VddptkWhunWxrpQikXAsLYzblU="'
+                }
+            }
+        options = {'timestampSkewSec': self._skewed_now()}
+        hawk.Server(req, lambda cid: CREDS[cid]).authenticate(dict(options))
+        server = hawk.Server(req, lambda cid: CREDS[cid])
+        self.assertRaises(hawk.server.BadRequest, server.authenticate,
+                          dict(options))
+
+    def test_single_flight(self):
+        release = threading.Event()
+        calls = []
+
+        def slow_lookup(cid):
+            calls.append(cid)
+            release.wait()
+            return CREDS[cid]
+
+        lookup = hawk.util.SingleFlight(slow_lookup)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(lookup('foobar-1234')))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while lookup.calls + lookup.shared < 5:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert calls == ['foobar-1234']
+        assert results == [CREDS['foobar-1234']] * 5
+        self.assertRaises(KeyError, lookup, 'unknown')
+
+        # Waiters of an interrupted call get an error, not None
+        release.clear()
+
+        def interrupted_lookup(cid):
+            release.wait()
+            raise SystemExit
+
+        lookup = hawk.util.SingleFlight(interrupted_lookup)
+        errors = []
+
+        def call():
+            try:
+                results.append(lookup('foobar-1234'))
+            except hawk.util.LookupInterrupted as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while lookup.calls + lookup.shared < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert len(errors) == 2 and len(results) == 5
+
+    def test_credentials_cache(self):
+        lookups = []
+        def credentials_fn(cid):
+            lookups.append(cid)
+            return CREDS[cid]
+
+        cache = hawk.util.CredentialsCache(credentials_fn)
+        assert cache('foobar-1234') == CREDS['foobar-1234']
+        assert cache('foobar-1234') == CREDS['foobar-1234']
+        self.assertRaises(KeyError, cache, 'unknown')
+        self.assertRaises(KeyError, cache, 'unknown')
+        assert lookups == ['foobar-1234', 'unknown']
+
+        cache.invalidate('foobar-1234')
+        cache('foobar-1234')
+        assert lookups == ['foobar-1234', 'unknown', 'foobar-1234']
+
+    def test_header_reuses_credentials(self):
+        req = {
+            'method': 'GET',
+            'url': '/bazz?buzz=fizz&mode=ala',
+            'host': 'example.com',
+            'port': 80,
+            'headers': {
+                'authorization': 'Hawk id="foobar-1234", ts="1367927332", nonce="lwfuar", ext="and welcome!", mac="ZZI/y3M0gV7PWCRX1VddptkWhunWxrpQikXAsLYzblU="'
+                }
+            }
+        lookups = []
+        def credentials_fn(cid):
+            lookups.append(cid)
+            return CREDS[cid]
+
+        server = hawk.Server(req, credentials_fn)
+        artifacts = server.authenticate(
+            {'timestampSkewSec': self._skewed_now()})
+        header = server.header(artifacts, {'payload': 'Hello and welcome!',
+                                           'contentType': 'text/plain'})
+
+        assert lookups == ['foobar-1234']
+        assert header == 'Hawk mac="okjCR+o26FMhInYoJ1QO30Fu9cl3wGIWmwqydQXND+w=", hash="y+iZjG+hr2is3SmZLFOe551/LGS3PQPMY9ZWjToaNjg=", ext="and welcome!"'
+
+    def test_wsgi_middleware(self):
+        body = 'Hello and welcome!'
+        seen = {}
+
+        def app(environ, start_response):
+            seen['body'] = environ['wsgi.input'].read(5)
+            seen['artifacts'] = environ['hawk.artifacts']
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['Hello ', 'and welcome!']
+
+        def call(payload):
+            header = hawk.client.header(
+                'http://example.com:8000/resource?a=b', 'POST',
+                {'credentials': CREDS['foobar-1234'], 'payload': body,
+                 'contentType': 'text/plain', 'ext': 'and welcome!'})
+            environ = {
+                'REQUEST_METHOD': 'POST', 'PATH_INFO': '/resource',
+                'QUERY_STRING': 'a=b', 'HTTP_HOST': 'example.com:8000',
+                'CONTENT_TYPE': 'text/plain',
+                'CONTENT_LENGTH': str(len(payload)),
+                'HTTP_AUTHORIZATION': header['field'],
+                'wsgi.input': StringIO(payload), 'wsgi.url_scheme': 'http'}
+            response = {}
+            def start_response(status, headers, exc_info=None):
+                response['status'] = status
+                response['headers'] = dict((k.lower(), v) for k, v in headers)
+            middleware = hawk.wsgi.HawkMiddleware(app, CREDS.get)
+            response['body'] = ''.join(middleware(environ, start_response))
+            return header, response
+
+        header, response = call(body)
+        assert response['status'] == '200 OK'
+        assert seen['body'] == 'Hello'
+        assert seen['artifacts']['resource'] == '/resource?a=b'
+        assert hawk.client.authenticate(response, CREDS['foobar-1234'],
+                                        header['artifacts'],
+                                        {'payload': response['body']})
+
+        header, response = call('Tampered body')
+        assert response['status'] == '401 Unauthorized'
+        assert response['headers']['www-authenticate'] == \
+            'Hawk error="Bad payload hash"'
+        assert hawk.client.authenticate(response, CREDS['foobar-1234'],
+                                        header['artifacts'],
+                                        {'required': True}) is False
+
+        # Malformed client headers are a 400, not an unhandled ValueError
+        assert hawk.wsgi.split_host('[::1]:8000') == ('[::1]', 8000)
+        self.assertRaises(ValueError, hawk.wsgi.split_host, 'example.com:abc')
+        self.assertRaises(ValueError, hawk.wsgi.split_host, 'example.com:0')
+        for bad in [{'HTTP_HOST': 'example.com:abc'},
+                    {'CONTENT_LENGTH': '12abc'},
+                    {'CONTENT_LENGTH': '-1'}]:
+            environ = dict({
+                'REQUEST_METHOD': 'POST', 'PATH_INFO': '/resource',
+                'HTTP_HOST': 'example.com:8000', 'CONTENT_LENGTH': '5',
+                'HTTP_AUTHORIZATION': header['field'],
+                'wsgi.input': StringIO('Hello'), 'wsgi.url_scheme': 'http'},
+                **bad)
+            statuses = []
+            middleware = hawk.wsgi.HawkMiddleware(app, CREDS.get)
+            middleware(environ, lambda status, headers: statuses.append(
+                status))
+            assert statuses == ['400 Bad Request']
+
+    def test_authenticator(self):
+        authenticator = hawk.Authenticator(
+            lambda cid: CREDS[cid], timestamp_skew_sec=self._skewed_now(),
+            check_nonce_fn=lambda nonce, ts: True)
+        self.assertRaises(AttributeError, setattr, authenticator,
+                          'timestamp_skew_sec', 0)
+
+        options = {'credentials': CREDS['foobar-1234'], 'ext': 'shared'}
+        frozen = dict(options)
+        errors = []
+
+        def worker():
+            try:
+                for _ in range(50):
+                    header = hawk.client.header(url, 'GET', options)
+                    req = {'method': 'GET', 'url': url,
+                           'host': 'example.com', 'port': 80,
+                           'headers': {'authorization': header['field']}}
+                    artifacts = authenticator.authenticate(req)
+                    assert authenticator.header(artifacts, {'ext': 'bye'})
+            except Exception as exc:  # pylint: disable=W0703
+                errors.append(exc)
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert options == frozen
+
+    def test_instrumentation(self):
+        req = {
+            'method': 'GET',
+            'url': '/bazz?buzz=fizz&mode=ala',
+            'host': 'example.com',
+            'port': 80,
+            'headers': {
+                'authorization': 'Hawk id="foobar-1234", ts="1367927332", nonce="lwfuar", ext="and welcome!", mac="ZZI/y3M0gV7PWCRX1VddptkWhunWxrpQikXAsLYzblU="'
+                }
+            }
+        collector = hawk.instrument.HistogramCollector()
+        hawk.instrument.install(collector)
+        try:
+            hawk.Server(req, lambda cid: CREDS[cid]).authenticate(
+                {'timestampSkewSec': self._skewed_now()})
+            self.assertRaises(hawk.server.BadRequest, hawk.Server(
+                req, lambda cid: CREDS[cid]).authenticate,
+                {'timestampSkewSec': self._skewed_now()})
+        finally:
+            hawk.instrument.uninstall(collector)
+
+        snapshot = collector.snapshot()
+        assert sorted(snapshot['histograms']) == sorted(
+            ['header_parse', 'credentials', 'mac', 'nonce', 'skew',
+             'payload_hash', 'nonce_record'])
+        # The replay is rejected before its MAC is checked
+        assert snapshot['histograms']['mac']['count'] == 1
+        assert snapshot['histograms']['header_parse']['count'] == 2
+        assert snapshot['counters'] == {'authenticated': 1, 'rejected': 1,
+                                        'rejected.nonce': 1}
+
+        text = hawk.instrument.prometheus_text(collector)
+        assert 'hawk_phase_seconds_count{phase="mac"} 1' in text
+        assert 'hawk_events_total{event="rejected"} 1' in text
+
+    def test_signer(self):
+        signer = hawk.client.Signer(CREDS['foobar-1234'])
+        options = {'ext': 'and welcome!', 'nonce': 'lwfuar',
+                   'timestamp': 1367927332, 'payload': 'Hello'}
+        for signed_url in [url, 'https://Example.com:8443/a/b?c=d#frag',
+                           'http://example.com', 'http://example.com?x=1',
+                           'http://example.com/a;params?b=c',
+                           u'http://example.com/caf\xe9?q=\u2603']:
+            expected = hawk.client.header(signed_url, 'POST', dict(
+                options, credentials=CREDS['foobar-1234']))
+            assert signer.header(signed_url, 'POST', options) == expected
+
+        assert signer.bewit(u'http://example.com/caf\xe9', 1367927332) == \
+            hawk.client.get_bewit(u'http://example.com/caf\xe9', {
+                'credentials': CREDS['foobar-1234'],
+                'ttl_sec': 1367927332 - time.time()})
+
+        based = hawk.client.Signer(CREDS['foobar-1234'],
+                                   base_url='http://example.com/')
+        assert based.header('/bazz?buzz=fizz&mode=ala', 'POST', options) == \
+            signer.header(url, 'POST', options)
+
+        self.assertRaises(hawk.server.BadRequest, hawk.client.Signer,
+                          {'id': 'no-key'})
+
+    def test_nonce_generator(self):
+        generator = hawk.hcrypto.NonceGenerator(block_size=30)
+        nonces = [generator(6) for _ in range(100)]
+        assert len(set(nonces)) == 100
+        for nonce in nonces:
+            assert len(nonce) == 6
+            hawk.util.check_header_attribute(nonce)
+
+        # A forked child discards the buffer it inherited
+        generator._pid = -1
+        assert generator(6) not in nonces
+
+        header = hawk.client.header(url, 'GET', {
+            'credentials': CREDS['foobar-1234']})
+        assert len(header['artifacts']['nonce']) == 6
+
+    def test_bewit_cache(self):
+        cache = hawk.server.default_bewit_cache
+        cache.clear()
+        bewit = hawk.client.get_bewit(url, {'credentials': CREDS['foobar-1234'],
+                                            'ttl_sec': 60 * 1000})
+        for query in ['/bazz?buzz=fizz&mode=ala&bewit=' + bewit,
+                      '/bazz?bewit=' + bewit + '&buzz=fizz&mode=ala']:
+            req = {'method': 'GET', 'url': query, 'host': 'example.com',
+                   'port': 80, 'headers': {}}
+            server = hawk.Server(req, lambda cid: CREDS[cid])
+            assert server.authenticate_bewit({})
+            assert server.authenticate_bewit({})
+        # Both urls normalize to the same resource, only one is computed
+        assert cache.stats()['misses'] == 1
+        assert cache.stats()['hits'] == 3
+        # The shared cache never holds the key itself
+        assert len(cache) == 1
+        assert not [part for entry in cache._entries for part in entry
+                    if part == CREDS['foobar-1234']['key']]
+
+        # A rotated key misses the cache and fails the MAC
+        rotated = dict(CREDS['foobar-1234'], key='rotated key')
+        self.assertRaises(hawk.server.BadRequest,
+                          hawk.Server(req, lambda cid: rotated)
+                          .authenticate_bewit, {})
+
+        req['url'] = '/bazz?buzz=fizz&mode=other&bewit=' + bewit
+        self.assertRaises(hawk.server.BadRequest,
+                          hawk.Server(req, lambda cid: CREDS[cid])
+                          .authenticate_bewit, {})
+
+    def test_get_bewits(self):
+        uris = [url, 'https://example.com:8443/a?b=c',
+                'http://example.com/a;b?c', 'http://example.com']
+        real_time = time.time
+        time.time = lambda: 1367927332.5
+        try:
+            bewits = hawk.client.get_bewits(uris, CREDS['foobar-1234'], 60,
+                                            ext='some-app-data')
+            expected = [hawk.client.get_bewit(uri, {
+                'credentials': CREDS['foobar-1234'], 'ttl_sec': 60,
+                'ext': 'some-app-data'}) for uri in uris]
+        finally:
+            time.time = real_time
+        assert bewits == expected
+
+    def test_offload_payload_hash(self):
+        authenticator = hawk.Authenticator(
+            lambda cid: CREDS[cid], timestamp_skew_sec=self._skewed_now(),
+            offload_hash_bytes=1024)
+        payload = 'x' * 4096
+        options = {'credentials': CREDS['foobar-1234'], 'payload': payload,
+                   'contentType': 'text/plain'}
+
+        def request(body):
+            header = hawk.client.header(url, 'POST', options)
+            return {'method': 'POST', 'url': url, 'host': 'example.com',
+                    'port': 80, 'contentType': 'text/plain',
+                    'headers': {'authorization': header['field']}}
+
+        artifacts = authenticator.authenticate(request(payload), payload)
+        assert artifacts['hash']
+        self.assertRaises(hawk.server.BadRequest,
+                          authenticator.authenticate, request(payload),
+                          'y' * 4096)
+
+    def test_artifacts(self):
+        artifacts = hawk.util.Artifacts(
+            method='GET', host='Example.com', port=80, resource='/a',
+            ts=1367927332, nonce='lwfuar', hash='', ext='hi')
+        assert artifacts['ext'] == 'hi'
+        assert 'mac' not in artifacts and artifacts.get('mac') is None
+        self.assertRaises(KeyError, artifacts.__getitem__, 'mac')
+        self.assertRaises(KeyError, artifacts.__setitem__, 'bogus', 1)
+        assert dict(artifacts) == {
+            'method': 'GET', 'host': 'Example.com', 'port': 80,
+            'resource': '/a', 'ts': 1367927332, 'nonce': 'lwfuar',
+            'hash': '', 'ext': 'hi'}
+        assert artifacts.fragment() == \
+            '1367927332\nlwfuar\nGET\n/a\nexample.com\n80'
+
+        copied = artifacts.copy()
+        copied['resource'] = '/b'
+        assert copied.fragment().endswith('/b\nexample.com\n80')
+        assert artifacts['resource'] == '/a'
+        del copied['ext']
+        assert 'ext' not in copied and len(copied) == 7
+
+        # Attribute writes invalidate the fragment too
+        copied.resource = '/c'
+        assert copied.fragment().endswith('/c\nexample.com\n80')
+
+        assert json.loads(json.dumps(artifacts.to_dict())) == artifacts
+
+        # The credentials, and with them the key, are never pickled
+        artifacts.credentials = CREDS['foobar-1234']
+        restored = pickle.loads(pickle.dumps(artifacts))
+        assert restored == artifacts
+        assert restored.credentials is None
+        assert CREDS['foobar-1234']['key'] not in pickle.dumps(artifacts)
+
+    def test_header_reuses_normalization(self):
+        authenticator = hawk.Authenticator(
+            lambda cid: CREDS[cid], timestamp_skew_sec=self._skewed_now())
+        header = hawk.client.header(url, 'GET', {
+            'credentials': CREDS['foobar-1234'], 'ext': 'hello'})
+        req = {'method': 'GET', 'url': url, 'host': 'example.com',
+               'port': 80, 'headers': {'authorization': header['field']}}
+        artifacts = authenticator.authenticate(req)
+        fragment = artifacts.fragment()
+        frozen = dict(artifacts)
+
+        options = {'payload': 'Bye', 'contentType': 'text/plain',
+                   'ext': 'bye'}
+        signed = authenticator.header(artifacts, options)
+        assert signed == authenticator.header(dict(artifacts), options)
+        # Unpickled artifacts have their credentials looked up again
+        assert signed == authenticator.header(
+            pickle.loads(pickle.dumps(artifacts)), options)
+        assert signed == authenticator.header(
+            artifacts, dict(options, contentKey='test-reuse-bye'))
+        assert artifacts.fragment() is fragment
+        assert dict(artifacts) == frozen
+
+        resp = {'headers': {'content-type': 'text/plain',
+                            'server-authorization': signed}}
+        assert hawk.client.authenticate(resp, CREDS['foobar-1234'],
+                                        header['artifacts'],
+                                        {'payload': 'Bye'})
+
+    def test_raw_mac_compare(self):
+        mac = 'ZZI/y3M0gV7PWCRX1VddptkWhunWxrpQikXAsLYzblU='
+        raw = hawk.hcrypto.decode_mac(mac)
+        assert len(raw) == 32
+        assert hawk.hcrypto.decode_mac(mac[:-1]) is None
+        assert hawk.hcrypto.decode_mac(mac[:10] + '!' + mac[10:]) is None
+        assert hawk.util.compare(u'abc', 'abc')
+        assert not hawk.util.compare('abc', 'abd')
+
+        req = {
+            'method': 'GET', 'url': '/bazz?buzz=fizz&mode=ala',
+            'host': 'example.com', 'port': 80,
+            'headers': {'authorization': 'Hawk id="foobar-1234", ts="1367927332", nonce="lwfuar", ext="and welcome!", mac="ZZI/y3M0gV7PWCRX1VddptkWhunW xrpQikXAsLYzblU="'}
+        }
+        server = hawk.Server(req, lambda cid: CREDS[cid])
+        self.assertRaises(hawk.server.BadMac, server.authenticate,
+                          {'timestampSkewSec': self._skewed_now()})
+
+    def test_algorithms(self):
+        assert hawk.hcrypto.module_for_algorithm('sha1') is hashlib.sha1
+        self.assertRaises(hawk.hcrypto.UnknownAlgorithm,
+                          hawk.hcrypto.module_for_algorithm, 'rot13')
+        hawk.hcrypto.register_algorithm('sha384', hashlib.sha384)
+        try:
+            assert 'sha384' in hawk.hcrypto.algorithms()
+
+            for algorithm in ['sha1', 'sha512', 'sha384']:
+                creds = {'id': 'alg', 'key': 'secret',
+                         'algorithm': algorithm}
+                header = hawk.client.header(url, 'POST', {
+                    'credentials': creds, 'payload': 'body',
+                    'contentType': 'text/plain'})
+                req = {'method': 'POST', 'url': url, 'host': 'example.com',
+                       'port': 80, 'contentType': 'text/plain',
+                       'headers': {'authorization': header['field']}}
+                authenticator = hawk.Authenticator(
+                    lambda cid, creds=creds: creds,
+                    timestamp_skew_sec=self._skewed_now())
+                artifacts = authenticator.authenticate(req, 'body')
+                assert authenticator.header(artifacts, {'payload': 'ok'})
+
+            # Replacing the constructor of a name takes effect at once
+            creds = {'id': 'alg', 'key': 'secret', 'algorithm': 'sha384'}
+            options = {'credentials': creds, 'timestamp': 1367927332,
+                       'nonce': 'abc'}
+            header = hawk.client.header(url, 'GET', options)
+            empty = hawk.hcrypto.calculate_payload_hash('', 'sha384', '')
+            hawk.hcrypto.register_algorithm('sha384', hashlib.sha512)
+            assert hawk.client.header(url, 'GET', options) != header
+            assert hawk.client.header(url, 'GET', options) == \
+                hawk.client.header(url, 'GET', dict(options, credentials=dict(
+                    creds, algorithm='sha512')))
+            assert hawk.hcrypto.calculate_payload_hash('', 'sha384', '') == \
+                hawk.hcrypto.calculate_payload_hash('', 'sha512', '')
+            assert empty != hawk.hcrypto.calculate_payload_hash(
+                '', 'sha384', '')
+        finally:
+            hawk.hcrypto.unregister_algorithm('sha384')
+        assert 'sha384' not in hawk.hcrypto.algorithms()
+        self.assertRaises(hawk.hcrypto.UnknownAlgorithm,
+                          hawk.hcrypto.calculate_payload_hash, 'body',
+                          'sha384', 'text/plain')
+
+    def test_payload_hash_cache(self):
+        cache = hawk.hcrypto.PayloadHashCache(max_size=10)
+        body = 'static body ' * 1000
+        expected = hawk.hcrypto.calculate_payload_hash(body, 'sha256',
+                                                       'text/plain')
+        handle, path = tempfile.mkstemp(prefix='pyhawk-test-')
+        try:
+            with os.fdopen(handle, 'wb') as out:
+                out.write(body)
+            assert cache.hash_file(path, 'sha256', 'text/plain') == expected
+            assert cache.hash_file(path, 'sha256', 'text/plain') == expected
+            assert cache.stats()['hits'] == 1
+
+            with open(path, 'wb') as out:
+                out.write('changed')
+            assert cache.hash_file(path, 'sha256', 'text/plain') == \
+                hawk.hcrypto.calculate_payload_hash('changed', 'sha256',
+                                                    'text/plain')
+            with open(path, 'wb'):
+                pass
+            assert cache.hash_file(path, 'sha256', '') == \
+                hawk.hcrypto.PayloadHasher('sha256', '').finalize()
+        finally:
+            os.remove(path)
+
+        assert cache.hash_payload('etag-1', body, 'sha256',
+                                  'text/plain') == expected
+        assert cache.hash_payload('etag-1', 'ignored', 'sha256',
+                                  'text/plain') == expected
+        cache.invalidate_key('etag-1')
+        assert cache.hash_payload('etag-1', 'new', 'sha256',
+                                  'text/plain') != expected
+
+    def test_authenticate_stream(self):
+        authenticator = hawk.Authenticator(
+            lambda cid: CREDS[cid], timestamp_skew_sec=self._skewed_now())
+        header = hawk.client.header(url, 'GET', {
+            'credentials': CREDS['foobar-1234']})
+        req = {'method': 'GET', 'url': url, 'host': 'example.com',
+               'port': 80, 'headers': {'authorization': header['field']}}
+        artifacts = authenticator.authenticate(req)
+        body = 'line one\nline two\n' * 1000
+        resp = {'headers': {
+            'content-type': 'text/plain',
+            'content-length': str(len(body)),
+            'server-authorization': authenticator.header(
+                artifacts, {'payload': body, 'contentType': 'text/plain'})}}
+
+        reader = hawk.client.authenticate_stream(
+            resp, CREDS['foobar-1234'], header['artifacts'],
+            StringIO(body + 'trailing'))
+        assert ''.join(iter(lambda: reader.read(4096), '')) == body
+        assert reader.verified
+
+        reader = hawk.client.authenticate_stream(
+            resp, CREDS['foobar-1234'], header['artifacts'],
+            StringIO(body.upper()))
+        self.assertRaises(hawk.hcrypto.InvalidPayloadHash, reader.drain)
+
+        # A malformed or missing length reads the body up to EOF
+        for length in ['12abc', None]:
+            if length is None:
+                del resp['headers']['content-length']
+            else:
+                resp['headers']['content-length'] = length
+            reader = hawk.client.authenticate_stream(
+                resp, CREDS['foobar-1234'], header['artifacts'],
+                StringIO(body))
+            assert reader.readlines()[-1] == 'line two\n' and reader.verified
+
+        # Without Server-Authorization the body is passed through as it is,
+        # unless the header is required
+        unsigned = {'headers': {'content-type': 'text/plain'}}
+        stream = StringIO(body)
+        assert hawk.client.authenticate_stream(
+            unsigned, CREDS['foobar-1234'], header['artifacts'],
+            stream) is stream
+        assert hawk.client.authenticate_stream(
+            unsigned, CREDS['foobar-1234'], header['artifacts'], stream,
+            {'required': True}) is False
+
+        resp['headers']['server-authorization'] = authenticator.header(
+            artifacts, {})
+        assert hawk.client.authenticate_stream(
+            resp, CREDS['foobar-1234'], header['artifacts'],
+            StringIO(body)) is False
+
+    def test_clock_offset(self):
+        # The server clock is an hour ahead of the client
+        lookups = []
+
+        def credentials_fn(cid):
+            lookups.append(cid)
+            return CREDS[cid]
+
+        credentials = hawk.util.CredentialsCache(credentials_fn)
+        authenticator = hawk.Authenticator(credentials,
+                                           localtime_offset_msec=3600 * 1000)
+        options = {'credentials': CREDS['foobar-1234']}
+
+        def request():
+            header = hawk.client.header(url, 'GET', options)
+            return header, {
+                'method': 'GET', 'url': url, 'host': 'example.com',
+                'port': 80, 'headers': {'authorization': header['field']}}
+
+        header, req = request()
+        try:
+            authenticator.authenticate(req)
+            self.fail('expected StaleTimestamp')
+        except hawk.server.StaleTimestamp as exc:
+            # Only cached credentials sign the challenge
+            assert authenticator.stale_challenge(exc) is None
+            assert lookups == []
+            credentials('foobar-1234')
+            challenge = authenticator.stale_challenge(exc)
+        assert challenge == authenticator.timestamp_challenge(
+            CREDS['foobar-1234'])
+        assert lookups == ['foobar-1234']
+
+        forged = {'headers': {'content-type': 'text/plain',
+                              'www-authenticate': challenge.replace(
+                                  'tsm="', 'tsm="x')}}
+        assert not hawk.client.authenticate(forged, CREDS['foobar-1234'],
+                                            header['artifacts'])
+        assert hawk.client.clock_offsets.get(('example.com', 80)) is None
+
+        resp = {'headers': {'content-type': 'text/plain',
+                            'www-authenticate': challenge}}
+        assert hawk.client.authenticate(resp, CREDS['foobar-1234'],
+                                        header['artifacts'])
+        offset = hawk.client.clock_offsets.get(('example.com', 80))
+        assert abs(offset - 3600 * 1000) < 2000
+
+        header, req = request()
+        assert authenticator.authenticate(req)
+
+    def test_stages(self):
+        self.assertRaises(ValueError, hawk.Authenticator, CREDS.get,
+                          stages=('timestamp', 'limits', 'nonce',
+                                  'credentials', 'mac', 'payload'))
+        self.assertRaises(ValueError, hawk.Authenticator, CREDS.get,
+                          stages=('limits', 'mac', 'credentials', 'payload',
+                                  'timestamp', 'nonce'))
+
+        lookups = []
+        def credentials_fn(cid):
+            lookups.append(cid)
+            return CREDS[cid]
+
+        def request(nonce, timestamp=None):
+            options = {'credentials': CREDS['foobar-1234'], 'nonce': nonce}
+            if timestamp is not None:
+                options['timestamp'] = timestamp
+            header = hawk.client.header(url, 'GET', options)
+            return {'method': 'GET', 'url': url, 'host': 'example.com',
+                    'port': 80,
+                    'headers': {'authorization': header['field']}}
+
+        authenticator = hawk.Authenticator(credentials_fn)
+        stale = request('stale1', time.time() - 3600)
+        try:
+            authenticator.authenticate(stale)
+            self.fail('expected StaleTimestamp')
+        except hawk.server.StaleTimestamp as exc:
+            assert authenticator.stale_challenge(exc) is None
+        assert lookups == []
+
+        # The middleware answers with an unsigned error instead
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/bazz',
+                   'QUERY_STRING': 'buzz=fizz&mode=ala',
+                   'HTTP_HOST': 'example.com',
+                   'HTTP_AUTHORIZATION': stale['headers']['authorization'],
+                   'wsgi.input': StringIO(''), 'wsgi.url_scheme': 'http'}
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response.update(headers)
+
+        middleware = hawk.wsgi.HawkMiddleware(None, credentials_fn)
+        middleware(environ, start_response)
+        assert response['WWW-Authenticate'] == 'Hawk error="Stale timestamp"'
+        assert lookups == []
+
+        # A forged request does not use up the nonce of the genuine one
+        genuine = request('nonce1')
+        forged = dict(genuine, url='/forged')
+        self.assertRaises(hawk.server.BadMac, authenticator.authenticate,
+                          forged)
+        assert authenticator.authenticate(genuine)
+        assert len(lookups) == 2
+        self.assertRaises(hawk.server.BadRequest, authenticator.authenticate,
+                          genuine)
+        assert len(lookups) == 2
+
+        late = hawk.Authenticator(credentials_fn, stages=(
+            'limits', 'credentials', 'mac', 'payload', 'timestamp', 'nonce'))
+        try:
+            late.authenticate(stale)
+            self.fail('expected StaleTimestamp')
+        except hawk.server.StaleTimestamp as exc:
+            assert exc.credentials == CREDS['foobar-1234']
+
     def _skewed_now(self):
         # Add 100 plus the difference between now and our hardcoded timestamp
         return time.time() - 1367927332 + 100
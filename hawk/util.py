@@ -4,7 +4,16 @@
 Various low level helper functions for HAWK authentication.
 """
 import logging
-from urlparse import urlparse
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+try:
+    from hmac import compare_digest as _compare_digest
+except ImportError:  # Python < 2.7.7
+    _compare_digest = None
+from urlparse import unquote, urlparse
 
 log = logging.getLogger(__name__)
 
@@ -23,17 +32,33 @@ class ParseError(HawkException):
     """ Exception raised for bad values. """
     pass
 
+
+class LookupInterrupted(RuntimeError):
+    """Raised by SingleFlight when the shared call died, e.g. SystemExit."""
+    pass
+
 # Allowed attribute value characters: !#$%&'()*+,-./:;<=>?@[]^_`{|}~ and
 # space, a-z, A-Z, 0-9
 ALLOWABLE_CHARS = ("!#$%&'()*+,-./:;<=>?@[]^_`{|}~ abcdefghijklmnopqrstuvwxyz"
                    "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789")
 
+# Headers longer than this are rejected before parsing
+MAX_HEADER_LENGTH = 4096
+
+_BAD_CHAR_RE = re.compile('[^' + re.escape(ALLOWABLE_CHARS) + ']')
+_SCHEME_RE = re.compile(r'(\S+)(?:\s+|$)')
+# key="value" followed by a comma or the end of the header. Values can not
+# contain quotes, so commas and '=' inside them are kept intact.
+_ATTRIBUTE_RE = re.compile(r'(\w+)="([^"\\]*)"\s*(?:,\s*|$)')
+
+DEFAULT_HEADER_KEYS = frozenset(['id', 'ts', 'nonce', 'hash',
+                                 'ext', 'mac', 'app', 'dlg'])
+
 
 def check_header_attribute(value):
     """ Validates header values contain allowable characters. """
-    for char in value:
-        if char not in ALLOWABLE_CHARS:
-            raise BadRequest
+    if _BAD_CHAR_RE.search(value) is not None:
+        raise BadRequest
     return value
 
 
@@ -43,58 +68,99 @@ def parse_authorization_header(auth_header, allowable_keys=None):
 
         'Hawk id="dh37fgj492je", ts="1367076201", nonce="NPHgnG", ext="and
         welcome!", mac="CeWHy4d9kbLGhDlkyw2Nh3PJ7SDOdZDa267KH4ZaNMY="'
+
+    Also used for Server-Authorization and WWW-Authenticate headers.
+    The header is scanned once, left to right.
     """
 
     if auth_header is None:
         raise BadRequest
 
+    if len(auth_header) > MAX_HEADER_LENGTH:
+        log.info("Header exceeds maximum length")
+        raise BadRequest
+
     if allowable_keys is None:
-        allowable_keys = ['id', 'ts', 'nonce', 'hash',
-                          'ext', 'mac', 'app', 'dlg']
+        allowable_keys = DEFAULT_HEADER_KEYS
 
-    attributes = {}
-    parts = auth_header.split(',')
-    auth_scheme_parts = parts[0].split(' ')
-    if not 'hawk' == auth_scheme_parts[0].lower():
-        log.info("Unknown scheme: " + auth_scheme_parts[0].lower())
+    scheme = _SCHEME_RE.match(auth_header)
+    if scheme is None or scheme.group(1).lower() != 'hawk':
+        log.info("Unknown scheme: %s", auth_header.split(' ', 1)[0])
         raise BadRequest
 
-    # Replace 'Hawk key: value' with 'key: value'
-    # which matches the rest of parts
-    parts[0] = auth_scheme_parts[1]
+    attributes = {}
+    pos = scheme.end()
+    end = len(auth_header)
+    while pos < end:
+        match = _ATTRIBUTE_RE.match(auth_header, pos)
+        if match is None:
+            log.info("Bad header syntax at offset %d", pos)
+            raise BadRequest
 
-    for part in parts:
-        attr_parts = part.split('=')
-        key = attr_parts[0].strip()
+        key, value = match.group(1, 2)
         if key not in allowable_keys:
-            log.info("Unknown Hawk key_" + attr_parts[0] + "_")
+            log.info("Unknown Hawk key_%s_", key)
             raise BadRequest
 
-        # TODO we don't do a good job of parsing, '=' should work for more =.
-        # hash or mac value includes '=' character... fixup
-        if len(attr_parts) == 3:
-            attr_parts[1] += '=' + attr_parts[2]
-
-        # Chop of quotation marks
-        value = attr_parts[1]
-
-        if attr_parts[1].find('"') == 0:
-            value = attr_parts[1][1:]
-
-        if value.find('"') > -1:
-            value = value[0:-1]
-
         check_header_attribute(value)
 
         if key in attributes:
             raise BadRequest
 
         attributes[key] = value
+        pos = match.end()
+
+    if not attributes:
+        raise BadRequest
 
     return attributes
 
+def extract_bewit(url):
+    """Finds the bewit query parameter without parsing the whole query.
+
+    Returns the raw bewit value and the url with the parameter removed, or
+    None and the url when there is no single, non-empty bewit parameter.
+    """
+    query_start = url.find('?')
+    if query_start == -1:
+        return None, url
+    fragment = url.find('#', query_start)
+    if fragment != -1:
+        url = url[:fragment]
+
+    start = url.find('bewit=', query_start)
+    while start != -1 and url[start - 1] not in '?&':
+        start = url.find('bewit=', start + 1)
+    if start == -1:
+        return None, url
+
+    end = url.find('&', start)
+    if end == -1:
+        end = len(url)
+    bewit = url[start + len('bewit='):end]
+    if not bewit or url.find('&bewit=', end) != -1:
+        return None, url
+    if '%' in bewit:
+        bewit = unquote(bewit)
+
+    if url[start - 1] == '?':
+        # Keep the '?' for the parameters which follow the bewit
+        stripped = url[:start] + url[end + 1:]
+        if end == len(url):
+            stripped = url[:start - 1]
+    else:
+        stripped = url[:start - 1] + url[end:]
+    return bewit, stripped
+
+
 def compare(a, b):
     """ Constant time string comparision, mitigates side channel attacks. """
+    if _compare_digest is not None:
+        if isinstance(a, unicode):
+            a = a.encode('utf-8')
+        if isinstance(b, unicode):
+            b = b.encode('utf-8')
+        return _compare_digest(a, b)
     if len(a) != len(b):
       return False
     result = 0
@@ -124,3 +190,384 @@ def parse_normalized_url(url):
         elif url_parts.scheme == 'https':
             url_dict['port'] = 443
     return url_dict
+
+
+class LRUCache(object):
+    """Thread safe, bounded mapping with least-recently-used and TTL eviction.
+
+    :param max_size: maximum number of entries kept, oldest is dropped first
+    :param ttl_sec: seconds an entry stays valid, None means forever
+    """
+
+    def __init__(self, max_size=1024, ttl_sec=None):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                self.misses += 1
+                self.evictions += 1
+                return default
+            # Re-insert to mark as most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl_sec=None):
+        """Stores value under key, ttl_sec overrides the cache default."""
+        if ttl_sec is None:
+            ttl_sec = self.ttl_sec
+        expires = None
+        if ttl_sec is not None:
+            expires = time.time() + ttl_sec
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drops key from the cache, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drops every entry and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Returns a dict of size, hits, misses and evictions."""
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class _Flight(object):
+    """A call in progress, shared by every caller asking for the same key."""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Wraps a one argument lookup so concurrent calls share one call.
+
+    While a lookup for a key is in flight, other threads asking for the
+    same key wait for its result (or exception) instead of issuing their
+    own. If the call is interrupted by a BaseException such as SystemExit,
+    only the calling thread gets it, the waiting ones get
+    LookupInterrupted. Typically wraps a credentials_fn backed by a
+    remote store:
+
+        server = hawk.Server(req, SingleFlight(credentials_fn))
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+
+        try:
+            flight.result = self.fn(key)
+        except Exception:
+            flight.error = sys.exc_info()
+            raise
+        except BaseException:
+            # Waiting threads must not take this for a None result, nor
+            # exit in place of the interrupted one
+            flight.error = (LookupInterrupted, LookupInterrupted(key), None)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+class CredentialsCache(object):
+    """Caches the results of a credentials_fn.
+
+    Found credentials are kept for ttl_sec. Unknown ids (credentials_fn
+    returned nothing or raised a LookupError such as KeyError) are kept for
+    negative_ttl_sec and answered the same way without another lookup.
+    Other exceptions, e.g. a database being down, are never cached. Call
+    invalidate(id) when a key is rotated.
+
+    Wrap a SingleFlight to also coalesce concurrent misses:
+
+        credentials_fn = CredentialsCache(SingleFlight(lookup))
+    """
+
+    def __init__(self, credentials_fn, ttl_sec=300, max_size=10000,
+                 negative_ttl_sec=5):
+        self.credentials_fn = credentials_fn
+        self.negative_ttl_sec = negative_ttl_sec
+        self._cache = LRUCache(max_size, ttl_sec)
+
+    def __call__(self, cid):
+        entry = self._cache.get(cid)
+        if entry is not None:
+            found, value = entry
+            if found:
+                return value
+            if value is not None:
+                raise value
+            return None
+
+        try:
+            credentials = self.credentials_fn(cid)
+        except LookupError as exc:
+            self._cache.set(cid, (False, exc), self.negative_ttl_sec)
+            raise
+        if credentials:
+            self._cache.set(cid, (True, credentials))
+        else:
+            self._cache.set(cid, (False, None), self.negative_ttl_sec)
+        return credentials
+
+    def peek(self, cid):
+        """Returns the cached credentials for cid, never looks them up.
+
+        None if they are not cached or cid is known to be unknown.
+        """
+        entry = self._cache.get(cid)
+        if entry is not None and entry[0]:
+            return entry[1]
+        return None
+
+    def invalidate(self, cid):
+        """Forgets cached credentials, or their absence, for cid."""
+        self._cache.invalidate(cid)
+
+    def clear(self):
+        """Forgets every cached entry."""
+        self._cache.clear()
+
+    def stats(self):
+        """Returns size, hits, misses and evictions of the cache."""
+        return self._cache.stats()
+
+
+# Marks an Artifacts field which was never set
+_MISSING = object()
+
+
+def normalized_fragment(artifacts):
+    """Returns the ts to port lines shared by every normalized string."""
+    return '\n'.join([str(artifacts['ts']),
+                      artifacts['nonce'],
+                      artifacts['method'].upper(),
+                      artifacts['resource'],
+                      artifacts['host'].lower(),
+                      str(artifacts['port'])])
+
+
+class Artifacts(object):
+    """The artifacts of a request.
+
+    A fixed set of fields in __slots__, read and written like a dict, e.g.
+    artifacts['ext'], or as attributes. Fields which were never set are
+    missing from the mapping. The artifacts also remember the credentials
+    they were verified with, so responses can be signed without looking
+    them up again, and the normalized ts to port lines, which every
+    request and response MAC shares.
+
+    Artifacts are not a dict subclass, json.dumps needs to_dict(). Pickles
+    leave the credentials out, so no key is written to a session or cache
+    store; Server.header looks them up again.
+    """
+
+    FIELDS = ('method', 'host', 'port', 'resource', 'ts', 'nonce', 'hash',
+              'ext', 'app', 'dlg', 'mac', 'id')
+
+    __slots__ = FIELDS + ('credentials', '_fragment')
+
+    def __init__(self, method=_MISSING, host=_MISSING, port=_MISSING,
+                 resource=_MISSING, ts=_MISSING, nonce=_MISSING,
+                 hash=_MISSING, ext=_MISSING, app=_MISSING, dlg=_MISSING,
+                 mac=_MISSING, id=_MISSING):
+        # pylint: disable=W0622
+        # Bypasses __setattr__, there is no fragment to invalidate yet
+        init = object.__setattr__
+        init(self, 'method', method)
+        init(self, 'host', host)
+        init(self, 'port', port)
+        init(self, 'resource', resource)
+        init(self, 'ts', ts)
+        init(self, 'nonce', nonce)
+        init(self, 'hash', hash)
+        init(self, 'ext', ext)
+        init(self, 'app', app)
+        init(self, 'dlg', dlg)
+        init(self, 'mac', mac)
+        init(self, 'id', id)
+        init(self, 'credentials', None)
+        init(self, '_fragment', None)
+
+    def __setattr__(self, name, value):
+        if name in _FRAGMENT_FIELDS:
+            object.__setattr__(self, '_fragment', None)
+        object.__setattr__(self, name, value)
+
+    def fragment(self):
+        """Returns the memoized normalized_fragment of these artifacts."""
+        if self._fragment is None:
+            self._fragment = '\n'.join([str(self.ts), self.nonce,
+                                        self.method.upper(), self.resource,
+                                        self.host.lower(), str(self.port)])
+        return self._fragment
+
+    def __getitem__(self, key):
+        if key in _ARTIFACT_FIELDS:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in _ARTIFACT_FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self[key] = _MISSING
+
+    def __contains__(self, key):
+        return key in _ARTIFACT_FIELDS and \
+            getattr(self, key) is not _MISSING
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __nonzero__(self):
+        for key in self.FIELDS:
+            if getattr(self, key) is not _MISSING:
+                return True
+        return False
+
+    def __eq__(self, other):
+        if not isinstance(other, (dict, Artifacts)):
+            return NotImplemented
+        return dict(self.iteritems()) == dict(other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Artifacts(%r)' % dict(self.iteritems())
+
+    def get(self, key, default=None):
+        """Returns the field key, or default if it is missing."""
+        if key in _ARTIFACT_FIELDS:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                return value
+        return default
+
+    def keys(self):
+        """Returns the names of the fields which are set."""
+        return [key for key in self.FIELDS
+                if getattr(self, key) is not _MISSING]
+
+    def values(self):
+        """Returns the values of the fields which are set."""
+        return [getattr(self, key) for key in self.keys()]
+
+    def items(self):
+        """Returns (name, value) of the fields which are set."""
+        return list(self.iteritems())
+
+    def iteritems(self):
+        """Iterates over (name, value) of the fields which are set."""
+        for key in self.FIELDS:
+            value = getattr(self, key)
+            if value is not _MISSING:
+                yield key, value
+
+    def update(self, other=(), **fields):
+        """Sets fields from a mapping or (name, value) pairs."""
+        if hasattr(other, 'keys'):
+            other = [(key, other[key]) for key in other.keys()]
+        for key, value in other:
+            self[key] = value
+        for key, value in fields.iteritems():
+            self[key] = value
+
+    def copy(self):
+        """Returns a shallow copy, keeping credentials and the fragment."""
+        result = Artifacts.__new__(Artifacts)
+        for key in self.__slots__:
+            object.__setattr__(result, key, getattr(self, key))
+        return result
+
+    def to_dict(self):
+        """Returns the fields which are set as a plain dict."""
+        return dict(self.iteritems())
+
+    def __getstate__(self):
+        # The credentials hold the key, they are never pickled
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+
+_ARTIFACT_FIELDS = frozenset(Artifacts.FIELDS)
+_FRAGMENT_FIELDS = frozenset(['ts', 'nonce', 'method', 'resource', 'host',
+                              'port'])
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+"""
+WSGI middleware for HAWK Authentication.
+"""
+
+import logging
+
+import hawk.hcrypto as hcrypto
+import hawk.util as util
+from hawk.server import Authenticator, StaleTimestamp
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def request_from_environ(environ):
+    """Builds the request dict Server expects from a WSGI environ."""
+    scheme = environ.get('wsgi.url_scheme', 'http')
+    if 'HTTP_HOST' in environ:
+        host, port = split_host(environ['HTTP_HOST'], scheme)
+    else:
+        host = environ['SERVER_NAME']
+        port = int(environ.get('SERVER_PORT') or DEFAULT_PORTS.get(scheme))
+
+    url = environ.get('REQUEST_URI')
+    if not url:
+        url = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            url += '?' + environ['QUERY_STRING']
+
+    return {
+        'method': environ['REQUEST_METHOD'],
+        'url': url,
+        'host': host,
+        'port': port,
+        'contentType': environ.get('CONTENT_TYPE', ''),
+        'headers': {
+            'authorization': environ.get('HTTP_AUTHORIZATION', '')
+        }
+    }
+
+
+def split_host(host_header, scheme='http'):
+    """Splits a Host header into host and port, e.g. '[::1]:8000'.
+
+    Raises ValueError if the port is not a number from 1 to 65535.
+    """
+    host, sep, port = host_header.rpartition(':')
+    if not sep or host.startswith('[') and not host.endswith(']') or \
+            not host.startswith('[') and ':' in host:
+        # No port, or the colon belongs to a bare IPv6 address
+        return host_header, DEFAULT_PORTS.get(scheme)
+    if not port.isdigit() or not 0 < int(port) <= 65535:
+        raise ValueError('Bad port in Host header: %r' % host_header)
+    return host, int(port)
+
+
+def content_length(environ):
+    """Returns the request body length, None if it is not known.
+
+    Raises ValueError for a malformed or negative CONTENT_LENGTH.
+    """
+    if environ.get('wsgi.input_terminated'):
+        return None
+    length = environ.get('CONTENT_LENGTH')
+    if not length:
+        return 0
+    if not length.isdigit():
+        raise ValueError('Bad Content-Length: %r' % length)
+    return int(length)
+
+
+class HawkMiddleware(object):
+    """Authenticates requests before handing them to a WSGI application.
+
+    The header MAC is checked up front. If the request carries a payload
+    hash, wsgi.input is wrapped so the body is hashed while the
+    application reads it, and a mismatch raises InvalidPayloadHash at
+    EOF. Whatever the application left unread is drained and verified
+    once it returned (a 401 is sent instead of a sized response), so the
+    body is never buffered or read twice.
+
+    Requests with a stale timestamp get a 401 carrying the signed server
+    time if credentials_fn is a util.CredentialsCache which already holds
+    their credentials, see Authenticator.stale_challenge. Otherwise the
+    401 only carries error="Stale timestamp", stale requests never cause
+    a credentials lookup.
+
+    The artifacts are available to the application as
+    environ['hawk.artifacts']. Responses are signed with a
+    Server-Authorization header, including a payload hash when the body
+    is a list or other sized iterable.
+
+    :param app: the WSGI application
+    :param credentials_fn: Callback to lookup credentials, see Server
+    :param options: options for Server.authenticate, turned into one
+                    Authenticator shared by all requests
+    :param require_payload_hash: reject requests with a body but no hash
+    """
+
+    def __init__(self, app, credentials_fn, options=None,
+                 require_payload_hash=False):
+        self.app = app
+        self.authenticator = Authenticator.from_options(credentials_fn,
+                                                        options or {})
+        self.require_payload_hash = require_payload_hash
+
+    def __call__(self, environ, start_response):
+        try:
+            req = request_from_environ(environ)
+            # Checked before authenticating, so the nonce is not used up
+            length = content_length(environ)
+        except ValueError as exc:
+            log.info("Bad request: %s", exc)
+            return self._bad_request(start_response)
+
+        if not req['headers']['authorization'] and \
+                'bewit=' in environ.get('QUERY_STRING', ''):
+            return self._call_with_bewit(req, environ, start_response)
+
+        try:
+            artifacts = self.authenticator.authenticate(req)
+        except StaleTimestamp as exc:
+            log.info("Stale timestamp in request to %s", req['url'])
+            return self._stale(exc, start_response)
+        except (util.HawkException, KeyError):
+            log.info("Unauthorized request to %s", req['url'])
+            return self._unauthorized(start_response)
+
+        reader = None
+        if artifacts['hash']:
+            hasher = hcrypto.PayloadHasher(
+                artifacts.credentials['algorithm'], req['contentType'])
+            reader = hcrypto.VerifyingReader(
+                environ['wsgi.input'], hasher, artifacts['hash'], length)
+            environ['wsgi.input'] = reader
+        elif self.require_payload_hash and length != 0:
+            log.info("Missing required payload hash")
+            return self._unauthorized(start_response, 'Missing payload hash')
+
+        environ['hawk.artifacts'] = artifacts
+        response = _Response(self.authenticator, artifacts, start_response,
+                             reader)
+        try:
+            app_iter = self.app(environ, response.start_response)
+            return response.finish(app_iter)
+        except hcrypto.InvalidPayloadHash:
+            if response.sent:
+                raise
+            return self._unauthorized(start_response, 'Bad payload hash')
+
+    def _call_with_bewit(self, req, environ, start_response):
+        """Authenticates a bewit request and calls the application."""
+        try:
+            if not self.authenticator.authenticate_bewit(req):
+                return self._unauthorized(start_response, 'Bad bewit')
+        except (util.HawkException, KeyError, TypeError, ValueError):
+            log.info("Invalid bewit")
+            return self._unauthorized(start_response, 'Bad bewit')
+        environ['hawk.bewit'] = True
+        return self.app(environ, start_response)
+
+    def _stale(self, exc, start_response):
+        """Sends a 401 with the signed server time, if it can be signed."""
+        challenge = self.authenticator.stale_challenge(exc)
+        if challenge is None:
+            return self._unauthorized(start_response, 'Stale timestamp')
+        return self._unauthorized(start_response, challenge=challenge)
+
+    def _bad_request(self, start_response):
+        """Sends a 400 for a request which can not be parsed."""
+        start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+        return ['Bad request']
+
+    def _unauthorized(self, start_response, error='Unauthorized',
+                      challenge=None):
+        """Sends a 401 asking for HAWK credentials.
+
+        The WWW-Authenticate header carries error, unless a signed
+        challenge is given.
+        """
+        if challenge is None:
+            challenge = 'Hawk error="%s"' % error
+        start_response('401 Unauthorized',
+                       [('Content-Type', 'text/plain'),
+                        ('WWW-Authenticate', challenge)])
+        return ['Please authenticate']
+
+
+class _Response(object):
+    """Holds back start_response until the response can be signed."""
+
+    def __init__(self, authenticator, artifacts, start_response,
+                 reader=None):
+        self.authenticator = authenticator
+        self.artifacts = artifacts
+        self.reader = reader
+        self._start_response = start_response
+        self.status = None
+        self.headers = None
+        self.exc_info = None
+        self.sent = False
+        self._written = None
+
+    def start_response(self, status, headers, exc_info=None):
+        """WSGI start_response, called by the application."""
+        if exc_info is not None and self.sent:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.status = status
+        self.headers = list(headers)
+        self.exc_info = exc_info
+        return self._write
+
+    def _write(self, data):
+        """Legacy write callable, sends the headers unsigned by payload."""
+        if not self.sent:
+            self._send()
+        self._written(data)
+
+    def _send(self, p_hash=None):
+        """Signs the response and calls the real start_response."""
+        options = {}
+        if p_hash is not None:
+            options['hash'] = p_hash
+        header = self.authenticator.header(self.artifacts, options)
+        headers = self.headers
+        if header:
+            headers = headers + [('Server-Authorization', header)]
+        self.sent = True
+        self._written = self._start_response(self.status, headers,
+                                             self.exc_info)
+
+    def finish(self, app_iter):
+        """Signs the response once the application returned its body.
+
+        A sized body is complete, so unread input is verified and the body
+        hashed before anything is sent. Other iterables are streamed and
+        the input is verified once they are exhausted.
+        """
+        if self.sent or self.status is None or \
+                not hasattr(app_iter, '__len__'):
+            return self._stream(app_iter)
+
+        if self.reader is not None:
+            try:
+                self.reader.drain()
+            except hcrypto.InvalidPayloadHash:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+                raise
+
+        content_type = ''
+        for name, value in self.headers:
+            if name.lower() == 'content-type':
+                content_type = value
+        hasher = hcrypto.PayloadHasher(
+            self.artifacts.credentials['algorithm'], content_type)
+        self._send(hasher.update_from(app_iter).finalize())
+        return app_iter
+
+    def _stream(self, app_iter):
+        """Passes a lazily produced body through."""
+        try:
+            for chunk in app_iter:
+                if not self.sent:
+                    self._send()
+                yield chunk
+            if self.reader is not None:
+                self.reader.drain()
+            if not self.sent:
+                self._send()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -2,12 +2,20 @@
 
 import codecs
 import os
+import re
 from setuptools import setup
 
 
 def read(*parts):
     return codecs.open(os.path.join(os.path.dirname(__file__), *parts)).read()
 
+
+def find_version(*parts):
+    match = re.search(r"^__version__ = '([^']+)'", read(*parts), re.M)
+    if match is None:
+        raise RuntimeError('Unable to find __version__')
+    return match.group(1)
+
 LONG_DESCRIPTION = """
 Python libraries for the 'HAWK' HTTP authentication scheme
 
@@ -25,7 +33,7 @@ CHANGELOG = read('CHANGES.txt')
 
 setup(
     name="PyHawk",
-    version="0.1.3",
+    version=find_version('hawk', '__init__.py'),
     url='https://github.com/mozilla/PyHawk',
     author='Austin King',
     author_email='ozten@mozilla.com',